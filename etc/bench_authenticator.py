@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Load-tests the authenticator against a fake pachd (see fake_pachd.py),
+# reporting throughput and latency for logins, login page renders and spawns
+# at a given number of concurrent users. Requires the hub image's
+# dependencies.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from fake_pachd import FakePachd
+
+AUTHENTICATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images", "hub", "authenticator")
+
+SCENARIOS = ["login", "login-page", "spawn"]
+
+# Number of times to try logging in each user before the spawn scenario
+SETUP_ATTEMPTS = 10
+
+class FakeUser:
+    """The parts of a JupyterHub user that `pre_spawn_start` uses"""
+
+    def __init__(self, name, token):
+        self.name = name
+        self.token = token
+
+    @gen.coroutine
+    def get_auth_state(self):
+        return {"token": self.token}
+
+class FakeSpawner:
+    """The parts of a KubeSpawner that `pre_spawn_start` uses"""
+
+    def __init__(self):
+        self.environment = {}
+        self.extra_annotations = {}
+        self.volumes = []
+        self.volume_mounts = []
+        # Spawns are never in progress, so the authenticator's spawn
+        # timelines finish as soon as `pre_spawn_start` returns
+        self.pending = None
+        self.ready = True
+        self._waiting_for_response = False
+
+def percentile(sorted_values, p):
+    """Returns the `p`th percentile of `sorted_values`, by nearest rank"""
+    if not sorted_values:
+        return float("nan")
+    index = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+@gen.coroutine
+def run_scenario(name, f, users, requests):
+    """
+    Calls `f(i)` for `i` in `range(requests)`, from `users` concurrent
+    workers, and returns the scenario's results. `f` may return a future.
+    Calls that raise count as errors.
+    """
+    latencies = []
+    errors = []
+    remaining = iter(range(requests))
+
+    @gen.coroutine
+    def worker():
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                result = f(i)
+                if gen.is_future(result):
+                    yield result
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    yield [worker() for _ in range(users)]
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": len(errors),
+        "seconds": seconds,
+        "throughput": requests / seconds,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+@gen.coroutine
+def bench(authenticator, scenarios, users, requests):
+    @gen.coroutine
+    def login(i):
+        user = yield authenticator.authenticate(None, {"username": "", "password": "user{}".format(i % users)})
+        if user is None:
+            raise Exception("login failed")
+        return user
+
+    # Spawns need a session per user, so log everyone in up front, retrying
+    # through injected failures
+    sessions = []
+    if "spawn" in scenarios:
+        for i in range(users):
+            for attempt in range(SETUP_ATTEMPTS):
+                try:
+                    user = yield login(i)
+                    break
+                except Exception:
+                    if attempt == SETUP_ATTEMPTS - 1:
+                        raise
+                    yield gen.sleep(authenticator.breaker_reset_timeout if authenticator.breaker.is_open() else 0)
+            sessions.append(FakeUser(user["name"], user["auth_state"]["token"]))
+
+    def spawn(i):
+        return authenticator.pre_spawn_start(sessions[i % users], FakeSpawner())
+
+    scenario_functions = {
+        "login": login,
+        "login-page": lambda i: authenticator.custom_html,
+        "spawn": spawn,
+    }
+
+    results = []
+    for name in scenarios:
+        result = yield run_scenario(name, scenario_functions[name], users, requests)
+        results.append(result)
+    return results
+
+def parse_config(settings):
+    """Parses `--set name=value` arguments into authenticator traits"""
+    config = {}
+    for setting in settings:
+        name, _, value = setting.partition("=")
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+    return config
+
+def main(scenarios, users, requests, latency, jitter, error_rate, token_ttl, config, output_json):
+    sys.path.insert(0, AUTHENTICATOR_PATH)
+    from pachyderm_authenticator import PachydermAuthenticator
+
+    pachd = FakePachd(latency=latency, jitter=jitter, error_rate=error_rate, token_ttl=token_ttl)
+    port = pachd.start()
+    os.environ["PACHD_SERVICE_HOST"] = "127.0.0.1"
+    os.environ["PACHD_SERVICE_PORT"] = str(port)
+    # Otherwise python_pachyderm would prefer these over the above
+    os.environ.pop("PACHD_PEER_SERVICE_HOST", None)
+    os.environ.pop("PACHD_PEER_SERVICE_PORT", None)
+
+    @gen.coroutine
+    def run():
+        # The authenticator schedules background work on the current
+        # IOLoop, so it's created inside the running one
+        authenticator = PachydermAuthenticator(pach_auth_token=pachd.admin_token, **config)
+        results = yield bench(authenticator, scenarios, users, requests)
+        return results
+
+    try:
+        results = IOLoop.current().run_sync(run)
+    finally:
+        pachd.stop()
+
+    if output_json:
+        print(json.dumps({"results": results, "pachd_calls": pachd.calls}, indent=2))
+        return
+
+    print("{:<12} {:>9} {:>7} {:>9} {:>10} {:>9} {:>9}".format("scenario", "requests", "errors", "seconds", "req/s", "p50 ms", "p99 ms"))
+    for r in results:
+        print("{scenario:<12} {requests:>9} {errors:>7} {seconds:>9.2f} {throughput:>10.1f} {p50_ms:>9.1f} {p99_ms:>9.1f}".format(**r))
+    print()
+    print("pachd RPCs served:")
+    for (method, count) in sorted(pachd.calls.items()):
+        print("  {:<16} {}".format(method, count))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-tests the authenticator against a fake pachd.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Scenario to run. Can be given more than once. Defaults to all of them.")
+    parser.add_argument("--users", type=int, default=10, help="Number of concurrent users.")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests per scenario.")
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds that every pachd RPC takes.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum number of random seconds added to every pachd RPC's latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of pachd RPCs that fail with UNAVAILABLE.")
+    parser.add_argument("--token-ttl", type=float, default=None, help="Seconds until session tokens expire. By default, they don't.")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Sets an authenticator trait, e.g. `--set rpc_threadpool_workers=8`. Values are parsed as JSON if possible.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    main(args.scenario or SCENARIOS, args.users, args.requests, args.latency, args.jitter, args.error_rate, args.token_ttl, parse_config(args.set), args.json)
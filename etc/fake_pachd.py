@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# A stand-in for pachd, implementing just the auth and enterprise RPCs that the
+# authenticator uses. It's meant for benchmarking the authenticator locally,
+# without a Pachyderm enterprise cluster.
+#
+# Credentials work like a pachd deployed locally: any GitHub token
+# authenticates as the GitHub user with that name, and `otp/<name>` one-time
+# passwords authenticate as `<name>`. Credentials starting with `bad` are
+# rejected.
+
+import time
+import uuid
+import random
+import argparse
+import threading
+from concurrent import futures
+
+import grpc
+from python_pachyderm.service import Service
+from python_pachyderm.proto.auth import auth_pb2
+from python_pachyderm.proto.enterprise import enterprise_pb2
+
+# Error details returned by pachd, which the authenticator looks for
+AUTH_NOT_ACTIVATED_DETAILS = "the auth service is not activated"
+NO_AUTH_TOKEN_DETAILS = "no authentication token (try logging in)"
+BAD_AUTH_TOKEN_DETAILS = "provided auth token is corrupted or has expired (try logging in again)"
+
+class FakePachd:
+    """
+    An in-process fake pachd. Every RPC takes `latency` seconds, plus up to
+    `jitter` more, and fails with `UNAVAILABLE` with probability
+    `error_rate`. Tokens issued by `Authenticate` expire after `token_ttl`
+    seconds, or never if it's `None`.
+    """
+
+    def __init__(self, admin_token="admin", latency=0.0, jitter=0.0, error_rate=0.0, token_ttl=None,
+                 enterprise_state="ACTIVE", auth_activated=True, max_workers=32):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.enterprise_state = enterprise_state
+        self.auth_activated = auth_activated
+        self.max_workers = max_workers
+
+        # Maps tokens to a tuple of (username, expiry time or `None`)
+        self.tokens = {admin_token: ("github:admin", None)}
+        self.admin_token = admin_token
+        # Counts of RPCs served, by method name
+        self.calls = {}
+        # Guards `tokens` and `calls`, which are accessed from the server's
+        # worker threads
+        self.lock = threading.Lock()
+        self.server = None
+        self.port = None
+
+    def start(self, host="127.0.0.1", port=0):
+        """Starts serving in the background, returning the port"""
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.max_workers))
+        Service.AUTH.grpc_module.add_APIServicer_to_server(_AuthServicer(self), self.server)
+        Service.ENTERPRISE.grpc_module.add_APIServicer_to_server(_EnterpriseServicer(self), self.server)
+        self.port = self.server.add_insecure_port("{}:{}".format(host, port))
+        self.server.start()
+        return self.port
+
+    def stop(self):
+        self.server.stop(0)
+
+    def issue_token(self, username):
+        token = uuid.uuid4().hex
+        expires_at = time.time() + self.token_ttl if self.token_ttl is not None else None
+        with self.lock:
+            self.tokens[token] = (username, expires_at)
+        return token
+
+    def handle(self, method, context):
+        """
+        Does the common work for every RPC: records it, sleeps for the
+        configured latency, and injects failures.
+        """
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if self.error_rate and random.random() < self.error_rate:
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure")
+
+    def check_auth(self, context):
+        """
+        Returns the username and expiry time tied to the request's auth
+        token, aborting the RPC if there isn't a valid one.
+        """
+        if not self.auth_activated:
+            context.abort(grpc.StatusCode.UNKNOWN, AUTH_NOT_ACTIVATED_DETAILS)
+
+        token = dict(context.invocation_metadata()).get("authn-token")
+        if not token:
+            context.abort(grpc.StatusCode.UNKNOWN, NO_AUTH_TOKEN_DETAILS)
+
+        with self.lock:
+            username, expires_at = self.tokens.get(token, (None, None))
+        if username is None or (expires_at is not None and expires_at < time.time()):
+            context.abort(grpc.StatusCode.UNKNOWN, BAD_AUTH_TOKEN_DETAILS)
+
+        return username, expires_at
+
+class _AuthServicer(Service.AUTH.servicer):
+    def __init__(self, pachd):
+        self.pachd = pachd
+
+    def WhoAmI(self, request, context):
+        self.pachd.handle("WhoAmI", context)
+        username, expires_at = self.pachd.check_auth(context)
+        ttl = int(expires_at - time.time()) if expires_at is not None else 0
+        return auth_pb2.WhoAmIResponse(username=username, is_admin=username == "github:admin", ttl=ttl)
+
+    def Authenticate(self, request, context):
+        self.pachd.handle("Authenticate", context)
+        if not self.pachd.auth_activated:
+            context.abort(grpc.StatusCode.UNKNOWN, AUTH_NOT_ACTIVATED_DETAILS)
+
+        if request.one_time_password:
+            credential = request.one_time_password[len("otp/"):]
+            username = credential
+        else:
+            credential = request.github_token
+            username = "github:{}".format(credential)
+
+        if not credential or credential.startswith("bad"):
+            context.abort(grpc.StatusCode.UNKNOWN, "invalid credentials")
+
+        return auth_pb2.AuthenticateResponse(pach_token=self.pachd.issue_token(username))
+
+    def ExtendAuthToken(self, request, context):
+        self.pachd.handle("ExtendAuthToken", context)
+        username, _ = self.pachd.check_auth(context)
+        if username != "github:admin":
+            context.abort(grpc.StatusCode.UNKNOWN, "not authorized")
+
+        with self.pachd.lock:
+            if request.token not in self.pachd.tokens:
+                context.abort(grpc.StatusCode.UNKNOWN, "token not found")
+            token_username, _ = self.pachd.tokens[request.token]
+            self.pachd.tokens[request.token] = (token_username, time.time() + request.ttl)
+
+        return auth_pb2.ExtendAuthTokenResponse()
+
+class _EnterpriseServicer(Service.ENTERPRISE.servicer):
+    def __init__(self, pachd):
+        self.pachd = pachd
+
+    def GetState(self, request, context):
+        self.pachd.handle("GetState", context)
+        state = getattr(enterprise_pb2, self.pachd.enterprise_state)
+        return enterprise_pb2.GetStateResponse(state=state)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a fake pachd that implements the RPCs used by the authenticator.")
+    parser.add_argument("--port", type=int, default=30650, help="Port to listen on.")
+    parser.add_argument("--admin-token", default="admin", help="Auth token for the cluster admin.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds that every RPC takes.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum number of random seconds added to every RPC's latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of RPCs that fail with UNAVAILABLE.")
+    parser.add_argument("--token-ttl", type=float, default=None, help="Seconds until issued tokens expire. By default, they don't.")
+    parser.add_argument("--enterprise-state", default="ACTIVE", choices=["NONE", "ACTIVE", "EXPIRED"], help="Enterprise state to report.")
+    parser.add_argument("--no-auth", action="store_true", help="Act as if auth is not activated.")
+    args = parser.parse_args()
+
+    pachd = FakePachd(
+        admin_token=args.admin_token,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        token_ttl=args.token_ttl,
+        enterprise_state=args.enterprise_state,
+        auth_activated=not args.no_auth,
+    )
+    port = pachd.start(host="0.0.0.0", port=args.port)
+    print("fake pachd listening on port {}".format(port))
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pachd.stop()
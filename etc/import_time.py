@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Reports how long the authenticator takes to import, which is time added to
+# every Hub startup. Requires python >= 3.7, for `-X importtime`.
+
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+AUTHENTICATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images", "hub", "authenticator")
+
+IMPORT_TIME_PARSER = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$", re.MULTILINE)
+
+# Modules that should only be imported on first use, rather than at startup
+LAZY_MODULES = ["grpc", "python_pachyderm"]
+
+def import_times(python):
+    """
+    Imports the authenticator in a fresh interpreter, returning a list of
+    (module, self time in us, cumulative time in us) for every module it
+    imported. JupyterHub is imported first, since the Hub has always
+    imported it by the time it loads the authenticator.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in [AUTHENTICATOR_PATH, env.get("PYTHONPATH")] if p)
+
+    proc = subprocess.run(
+        [python, "-X", "importtime", "-c", "import jupyterhub.auth; import pachyderm_authenticator"],
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    stderr = proc.stderr.decode("utf8")
+    if proc.returncode != 0:
+        print(stderr, file=sys.stderr)
+        proc.check_returncode()
+
+    # Everything after jupyterhub.auth's own entry was imported by the
+    # authenticator
+    lines = IMPORT_TIME_PARSER.findall(stderr)
+    jupyterhub_index = max(i for i, (_, _, _, module) in enumerate(lines) if module == "jupyterhub.auth")
+    return [(module, int(self_us), int(cumulative_us)) for (self_us, cumulative_us, _, module) in lines[jupyterhub_index+1:]]
+
+def main(python, top, max_ms):
+    times = import_times(python)
+    total_us = next(cumulative_us for (module, _, cumulative_us) in times if module == "pachyderm_authenticator")
+
+    print("pachyderm_authenticator: {:.1f}ms".format(total_us / 1000))
+    print()
+    print("slowest modules (self time):")
+    for (module, self_us, _) in sorted(times, key=lambda t: t[1], reverse=True)[:top]:
+        print("  {:>8.1f}ms  {}".format(self_us / 1000, module))
+
+    failed = False
+
+    eager_modules = [module for (module, _, _) in times if module in LAZY_MODULES]
+    if eager_modules:
+        print("error: these modules should be imported lazily, but were imported with the authenticator: {}".format(", ".join(eager_modules)), file=sys.stderr)
+        failed = True
+
+    if max_ms is not None and total_us / 1000 > max_ms:
+        print("error: importing the authenticator took longer than {}ms".format(max_ms), file=sys.stderr)
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports how long the authenticator takes to import.")
+    parser.add_argument("--python", default=sys.executable, help="Python interpreter to import with. It must have the hub image's dependencies installed.")
+    parser.add_argument("--top", type=int, default=10, help="Number of the slowest modules to list.")
+    parser.add_argument("--max-ms", type=float, default=None, help="If set, exit with an error if the import takes longer than this many milliseconds.")
+    args = parser.parse_args()
+
+    main(args.python, args.top, args.max_ms)
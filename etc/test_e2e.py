@@ -6,13 +6,13 @@ import re
 import sys
 import json
 import time
+import uuid
 import asyncio
 import argparse
+import contextlib
 from urllib.parse import urljoin, quote as urlquote
 
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
-import requests
+import aiohttp
 import websockets
 
 MAX_LOAD_COUNT = 10
@@ -22,6 +22,20 @@ PYTHON_WHOAMI_PATTERN = re.compile(r'username: \".+\"')
 PACHCTL_VERSION_PATTERN = re.compile(r'COMPONENT +VERSION +\npachctl', re.MULTILINE)
 PYTHON_VERSION_PATTERN = re.compile(r'major: (\d+)\nminor: (\d+)', re.MULTILINE)
 
+# Checks run in terminal sessions, as (name, command, expected output, whether
+# it needs auth). Each starts a new process, so they're spread across several
+# sessions.
+TERMINAL_CHECKS = [
+    ("pachctl version", "pachctl version", PACHCTL_VERSION_PATTERN, False),
+    ("python_pachyderm version", "python3 -c 'import python_pachyderm; c = python_pachyderm.Client.new_in_cluster(); print(c.get_remote_version())'", PYTHON_VERSION_PATTERN, False),
+    ("pachctl whoami", "pachctl auth whoami", PACHCTL_WHOAMI_PATTERN, True),
+    ("python_pachyderm whoami", "python3 -c 'import python_pachyderm; c = python_pachyderm.Client.new_in_cluster(); print(c.who_am_i())'", PYTHON_WHOAMI_PATTERN, True),
+]
+
+# Phases of a load test run for each user, in order
+LOAD_PHASES = ["login", "spawn", "token", "terminal"]
+LOAD_PERCENTILES = [50, 90, 99]
+
 def retry(f, attempts=10, sleep=1.0):
     """
     Repeatedly retries an operation, ignore exceptions, n times with a given
@@ -37,29 +51,44 @@ def retry(f, attempts=10, sleep=1.0):
                 raise
             time.sleep(sleep)
 
-async def run_command(ws, cmd, timeout=1.0):
+async def run_command(ws, cmd, timeout=30.0):
     """
-    Runs a command in a terminal session available on a websocket connection
+    Runs a command in a terminal session available on a websocket connection,
+    returning its output. The command is wrapped in unique markers, so that
+    this returns as soon as it's done, and fails if it exits with a non-zero
+    status or doesn't finish within `timeout` seconds.
     """
 
-    await ws.send(json.dumps(["stdin", "{}\r\n".format(cmd)]))
-    await ws.recv() # ignore command being echoed back
+    # The markers are printed with a separator that doesn't appear in the
+    # echoed command, so that the echo isn't mistaken for them
+    marker = uuid.uuid4().hex
+    output_pattern = re.compile(r"BEGIN-{0}\n(.*?)\n?END-{0}-(\d+)\n".format(marker), re.DOTALL)
+    await ws.send(json.dumps(["stdin", "printf '%s-%s\\n' BEGIN {0}; {1}; printf '\\n%s-%s-%s\\n' END {0} $?\r\n".format(marker, cmd)]))
+
+    deadline = time.monotonic() + timeout
+    output = ""
 
-    start_time = time.time()
-    lines = []
+    while True:
+        match = output_pattern.search(output)
+        if match is not None:
+            break
 
-    while time.time() - start_time < timeout:
         try:
-            line = await asyncio.wait_for(ws.recv(), timeout=timeout)
+            message = await asyncio.wait_for(ws.recv(), timeout=deadline - time.monotonic())
         except asyncio.TimeoutError:
-            pass
-        else:
-            lines.append(json.loads(line))
+            raise AssertionError("command `{}` did not finish within {}s; output so far:\n{}".format(cmd, timeout, output))
 
-    # seems to always be true, even when stderr is printed to instead
-    assert all(stdio == "stdout" for (stdio, _) in lines)
+        (kind, text) = json.loads(message)[:2]
+        # the setup message can come after output the terminal had buffered
+        if kind == "setup":
+            continue
+        # seems to always be stdout, even when stderr is printed to instead
+        assert kind == "stdout", "unexpected terminal message: {}".format(message)
+        output += text.replace("\r\n", "\n")
 
-    return "".join(l.replace("\r\n", "\n") for (_, l) in lines)
+    (lines, exit_status) = match.groups()
+    assert exit_status == "0", "command `{}` exited with status {}:\n{}".format(cmd, exit_status, lines)
+    return lines
 
 def check_stdout(pattern, lines):
     """
@@ -68,11 +97,11 @@ def check_stdout(pattern, lines):
     assert pattern.search(lines) is not None, \
         "unexpected terminal output:\n{}".format(lines)
 
-def login(driver, url, username, password):
+def ui_login(driver, url, username, password):
     """
     Tests for successful login using selenium
     """
-    print("login")
+    print("ui login")
 
     # get the jupyterhub login page
     driver.get(url)
@@ -92,11 +121,11 @@ def login(driver, url, username, password):
         assert driver.title == "Home Page - Select or create a notebook", "unexpected page title: {}".format(driver.title)
     retry(check_title, attempts=30)
 
-def get_token(driver, url):
+def ui_get_token(driver, url):
     """
     Using selenium, this extracts an API token
     """
-    print("token")
+    print("ui token")
 
     driver.get(urljoin(url, "/hub/token"))
 
@@ -107,51 +136,302 @@ def get_token(driver, url):
         return token
     return retry(get_token)
 
-async def test_terminal(url, token, username, no_auth_check):
+async def run_terminal_checks(ws, checks, failures):
     """
-    Tests that it's possible to start a Jupyter terminal session, and that
-    expected dependencies are installed
+    Runs checks one after another in a terminal session, recording the error
+    each failed check raised in `failures`, by check name
     """
+    # Ignore the setup message
+    await ws.recv()
 
-    # Start a terminal session
-    res = requests.request("POST", urljoin(url, "/user/{}/api/terminals".format(urlquote(username))), data=dict(token=token))
-    res.raise_for_status()
-    term_name = res.json()["name"]
+    for (name, cmd, pattern, _) in checks:
+        start = time.monotonic()
+        try:
+            lines = await run_command(ws, cmd)
+            check_stdout(pattern, lines)
+        except Exception as e:
+            failures[name] = e
+            print("{}: failed after {:.1f}s".format(name, time.monotonic() - start))
+        else:
+            print("{}: ok in {:.1f}s".format(name, time.monotonic() - start))
 
-    # Use Jupyter's undocumented API for interacting with the terminal
-    # session.
-    # 1) Determine the websocket URL for the terminal session
+async def test_terminal(session, url, token, username, no_auth_check, terminals):
+    """
+    Tests that it's possible to start Jupyter terminal sessions, and that
+    expected dependencies are installed. The checks are spread across
+    `terminals` sessions, which run at the same time.
+    """
+    checks = [check for check in TERMINAL_CHECKS if not (no_auth_check and check[3])]
+    terminals = max(1, min(terminals, len(checks)))
+    term_names = []
+    failures = {}
+
+    try:
+        for _ in range(terminals):
+            term_names.append(await start_terminal(session, url, username, token))
+
+        # Use Jupyter's undocumented API for interacting with the terminal
+        # sessions
+        async with contextlib.AsyncExitStack() as stack:
+            sockets = []
+            for term_name in term_names:
+                ws_url = terminal_websocket_url(url, username, term_name, token)
+                sockets.append(await stack.enter_async_context(websockets.connect(ws_url)))
+
+            await asyncio.gather(*[
+                run_terminal_checks(ws, checks[i::terminals], failures)
+                for (i, ws) in enumerate(sockets)
+            ])
+    finally:
+        for term_name in term_names:
+            await delete_terminal(session, url, username, token, term_name)
+
+    if failures:
+        raise AssertionError("\n\n".join(
+            "{} failed: {}".format(name, failures[name])
+            for (name, _, _, _) in checks if name in failures
+        ))
+
+def terminal_websocket_url(url, username, term_name, token):
     ws_url = urljoin(url, "/user/{}/terminals/websocket/{}?token={}".format(urlquote(username), urlquote(term_name), urlquote(token)))
     ws_url = ws_url.replace("http://", "ws://")
     ws_url = ws_url.replace("https://", "wss://")
+    return ws_url
+
+def hub_api_headers(session, url):
+    """
+    Headers for cookie-authenticated requests to the hub API, which checks
+    that they come from the hub itself
+    """
+    headers = {"Referer": urljoin(url, "/hub/")}
+    for cookie in session.cookie_jar:
+        if cookie.key == "_xsrf":
+            headers["X-XSRFToken"] = cookie.value
+    return headers
+
+async def http_login(session, url, username, password):
+    """
+    Logs in through the hub's login form, leaving the login cookie in
+    `session`
+    """
+    # newer hubs set an XSRF cookie on the login page, which has to be sent
+    # back with the form
+    async with session.get(urljoin(url, "/hub/login")) as res:
+        res.raise_for_status()
+    data = dict(username=username, password=password)
+    for cookie in session.cookie_jar:
+        if cookie.key == "_xsrf":
+            data["_xsrf"] = cookie.value
+
+    async with session.post(urljoin(url, "/hub/login"), data=data, allow_redirects=False) as res:
+        # a failed login re-renders the login page, rather than redirecting
+        assert res.status == 302, "login failed with status {}".format(res.status)
+
+async def http_spawn(session, url, username, timeout=300.0):
+    """
+    Starts the user's server if it isn't running, and waits for it to be
+    ready by following the hub's spawn progress event stream
+    """
+    quoted_username = urlquote(username)
+    headers = hub_api_headers(session, url)
+
+    async with session.post(urljoin(url, "/hub/api/users/{}/server".format(quoted_username)), headers=headers) as res:
+        # 400 means the server is already running
+        assert res.status in (201, 202, 400), "could not start server: status {}: {}".format(res.status, await res.text())
+
+    progress_url = urljoin(url, "/hub/api/users/{}/server/progress".format(quoted_username))
+    async with session.get(progress_url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as res:
+        res.raise_for_status()
+        async for line in res.content:
+            line = line.decode("utf8").strip()
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[len("data:"):])
+            if event.get("failed"):
+                raise AssertionError("spawn failed: {}".format(event.get("message")))
+            if event.get("ready"):
+                return
+    raise AssertionError("spawn progress ended without the server becoming ready")
+
+async def http_create_token(session, url, username):
+    """Creates an API token for the user through the hub API"""
+    async with session.post(
+        urljoin(url, "/hub/api/users/{}/tokens".format(urlquote(username))),
+        headers=hub_api_headers(session, url),
+        json=dict(note="e2e test"),
+    ) as res:
+        res.raise_for_status()
+        # older hubs don't send a JSON content type
+        return json.loads(await res.text())["token"]
+
+async def start_terminal(session, url, username, token):
+    """
+    Starts a terminal session in the user's server, returning its name
+    """
+    terminals_url = urljoin(url, "/user/{}/api/terminals".format(urlquote(username)))
+    headers = {"Authorization": "token {}".format(token)}
+    async with session.post(terminals_url, headers=headers) as res:
+        res.raise_for_status()
+        return json.loads(await res.text())["name"]
+
+async def delete_terminal(session, url, username, token, term_name):
+    terminals_url = urljoin(url, "/user/{}/api/terminals/{}".format(urlquote(username), urlquote(term_name)))
+    headers = {"Authorization": "token {}".format(token)}
+    async with session.delete(terminals_url, headers=headers):
+        pass
+
+async def http_first_terminal_command(session, url, username, token):
+    """
+    Starts a terminal session, runs a command in it, and deletes it
+    """
+    term_name = await start_terminal(session, url, username, token)
+
+    try:
+        async with websockets.connect(terminal_websocket_url(url, username, term_name, token)) as ws:
+            # ignore the setup message
+            await ws.recv()
+            lines = await run_command(ws, "pachctl version")
+            check_stdout(PACHCTL_VERSION_PATTERN, lines)
+    finally:
+        await delete_terminal(session, url, username, token, term_name)
+
+async def http_stop(session, url, username):
+    async with session.delete(urljoin(url, "/hub/api/users/{}/server".format(urlquote(username))), headers=hub_api_headers(session, url)):
+        pass
+
+async def load_test_user(url, username, password, start_delay, semaphore, stop_server):
+    """
+    Runs each load test phase for a user, after `start_delay` seconds,
+    returning how long each phase took and the error that failed the run,
+    if any
+    """
+    await asyncio.sleep(start_delay)
+
+    result = dict(username=username, phases={}, error=None)
+    async with semaphore:
+        # each user gets their own cookies
+        async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+            async def run_phase(phase, coro):
+                start = time.monotonic()
+                try:
+                    value = await coro
+                except Exception as e:
+                    raise AssertionError("{}: {}".format(phase, str(e) or type(e).__name__)) from e
+                result["phases"][phase] = time.monotonic() - start
+                return value
+
+            try:
+                await run_phase("login", http_login(session, url, username, password))
+                await run_phase("spawn", http_spawn(session, url, username))
+                token = await run_phase("token", http_create_token(session, url, username))
+                await run_phase("terminal", http_first_terminal_command(session, url, username, token))
+            except AssertionError as e:
+                result["error"] = str(e)
+
+            if stop_server and "login" in result["phases"]:
+                await http_stop(session, url, username)
+
+    print("{}: {}".format(username, "failed ({})".format(result["error"]) if result["error"] else "ok"))
+    return result
+
+def percentile(sorted_values, p):
+    """Returns the `p`th percentile of `sorted_values`, by nearest rank"""
+    if not sorted_values:
+        return None
+    index = max(int(round(p / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+async def load_test(url, credentials, concurrency, ramp_up, stop_server):
+    """
+    Runs the load test phases for every (username, password) in
+    `credentials`, with up to `concurrency` users at once. User start times
+    are spread evenly over `ramp_up` seconds. Returns the results, with
+    latency percentiles for each phase.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.monotonic()
+    results = await asyncio.gather(*[
+        load_test_user(url, username, password, i * ramp_up / len(credentials), semaphore, stop_server)
+        for (i, (username, password)) in enumerate(credentials)
+    ])
+    duration = time.monotonic() - start
+
+    phases = {}
+    for phase in LOAD_PHASES:
+        latencies = sorted(r["phases"][phase] for r in results if phase in r["phases"])
+        phases[phase] = dict(count=len(latencies), max=latencies[-1] if latencies else None)
+        for p in LOAD_PERCENTILES:
+            phases[phase]["p{}".format(p)] = percentile(latencies, p)
+
+    return dict(
+        url=url,
+        users=len(results),
+        failures=sum(1 for r in results if r["error"]),
+        concurrency=concurrency,
+        ramp_up=ramp_up,
+        duration=duration,
+        phases=phases,
+        results=results,
+    )
+
+def read_credentials(path):
+    """
+    Reads a credentials file, with a whitespace-separated username and
+    password on each line. Blank lines and lines starting with `#` are
+    skipped.
+    """
+    credentials = []
+    with open(path, "r") as f:
+        for (line_number, line) in enumerate(f, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    raise ValueError("{}:{}: expected a username and password, separated by whitespace".format(path, line_number))
+                credentials.append(tuple(fields))
+    return credentials
+
+def load_main(url, credentials_path, concurrency, ramp_up, output_path, stop_server):
+    credentials = read_credentials(credentials_path)
+    summary = asyncio.run(load_test(url, credentials, concurrency, ramp_up, stop_server))
+
+    print()
+    print("{} users, {} failed, in {:.1f}s".format(summary["users"], summary["failures"], summary["duration"]))
+    print("{:<10} {:>6} {}".format("phase", "count", " ".join("{:>8}".format(p) for p in ["p{}".format(p) for p in LOAD_PERCENTILES] + ["max"])))
+    for phase in LOAD_PHASES:
+        stats = summary["phases"][phase]
+        values = [stats["p{}".format(p)] for p in LOAD_PERCENTILES] + [stats["max"]]
+        print("{:<10} {:>6} {}".format(phase, stats["count"], " ".join("{:>7.2f}s".format(v) if v is not None else "{:>8}".format("-") for v in values)))
+
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if summary["failures"]:
+        sys.exit(1)
+
+async def test_http(url, username, password, no_auth_check, terminals):
+    """
+    Logs in, waits for the user's server, and gets a token over HTTP, then
+    runs the terminal tests
+    """
+    async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+        print("login")
+        await http_login(session, url, username, password)
+        print("spawn")
+        await http_spawn(session, url, username)
+        print("token")
+        token = await http_create_token(session, url, username)
+        await test_terminal(session, url, token, username, no_auth_check, terminals)
+
+def test_ui(url, username, password, webdriver_path, headless, debug):
+    """
+    Smoke tests the login and token pages in a browser
+    """
+    # selenium is only needed for these tests
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
 
-    # 2) Connect with websockets
-    async with websockets.connect(ws_url) as ws:
-        # 3) Ignore the setup message
-        await ws.recv()
-
-        # 4) Check that `pachctl` is installed
-        print("pachctl version")
-        lines = await run_command(ws, "pachctl version")
-        check_stdout(PACHCTL_VERSION_PATTERN, lines)
-
-        # 5) Check that python_pachyderm is installed
-        print("python_pachyderm version")
-        lines = await run_command(ws, "python3 -c 'import python_pachyderm; c = python_pachyderm.Client.new_in_cluster(); print(c.get_remote_version())'")
-        check_stdout(PYTHON_VERSION_PATTERN, lines)
-        
-        if not no_auth_check:
-            # 6) Check that we're authenticated in `pachctl`
-            print("pachctl whoami")
-            lines = await run_command(ws, "pachctl auth whoami")
-            check_stdout(PACHCTL_WHOAMI_PATTERN, lines)
-
-            # 7) Check that we're authenticated in python_pachyderm
-            print("python_pachyderm whoami")
-            lines = await run_command(ws, "python3 -c 'import python_pachyderm; c = python_pachyderm.Client.new_in_cluster(); print(c.who_am_i())'")
-            check_stdout(PYTHON_WHOAMI_PATTERN, lines)
-
-def main(url, username, password, webdriver_path, headless, debug, no_auth_check):
     opts = Options()
     opts.headless = headless
 
@@ -160,24 +440,40 @@ def main(url, username, password, webdriver_path, headless, debug, no_auth_check
         driver = webdriver.Firefox(executable_path=webdriver_path, options=opts)
     else:
         driver = webdriver.Firefox(options=opts)
-    
-    # run tests
-    login(driver, url, username, password)
-    token = get_token(driver, url)
-    asyncio.run(test_terminal(url, token, username, no_auth_check))
+
+    ui_login(driver, url, username, password)
+    ui_get_token(driver, url)
 
     if not debug:
         driver.quit()
 
+def main(url, username, password, webdriver_path, headless, debug, no_auth_check, ui, terminals):
+    asyncio.run(test_http(url, username, password, no_auth_check, terminals))
+    if ui:
+        test_ui(url, username, password, webdriver_path, headless, debug)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("url", help="JupyterHub login url")
-    parser.add_argument("username", help="JupyterHub login username")
-    parser.add_argument("password", help="JupyterHub login password")
-    parser.add_argument("--webdriver", help="path to webdriver executable")
-    parser.add_argument("--headless", action="store_true", help="headless mode")
+    parser.add_argument("username", nargs="?", help="JupyterHub login username")
+    parser.add_argument("password", nargs="?", help="JupyterHub login password")
+    parser.add_argument("--ui", action="store_true", help="Also smoke test the login and token pages in Firefox, through selenium")
+    parser.add_argument("--webdriver", help="path to webdriver executable, for --ui")
+    parser.add_argument("--headless", action="store_true", help="headless mode, for --ui")
     parser.add_argument("--debug", action="store_true", help="debug mode")
     parser.add_argument("--no-auth-check", action="store_true", help="Disable auth-related tests")
+    parser.add_argument("--terminals", type=int, default=len(TERMINAL_CHECKS), help="Number of terminal sessions to spread the terminal checks across")
+    parser.add_argument("--load", metavar="CREDENTIALS", help="Run a load test rather than the end-to-end tests, with the users in the given file. Each line has a username and password, separated by whitespace.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum number of users to run at once in a load test")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which to spread out the start of each user in a load test")
+    parser.add_argument("--output", help="File to write load test results to, as JSON")
+    parser.add_argument("--stop-servers", action="store_true", help="Stop each user's server at the end of a load test")
     args = parser.parse_args()
 
-    main(args.url, args.username, args.password, args.webdriver, args.headless, args.debug, args.no_auth_check)
+    if args.load:
+        load_main(args.url, args.load, args.concurrency, args.ramp_up, args.output, args.stop_servers)
+        sys.exit(0)
+    if not args.username or not args.password:
+        parser.error("a username and password are required, unless running a load test")
+
+    main(args.url, args.username, args.password, args.webdriver, args.headless, args.debug, args.no_auth_check, args.ui, args.terminals)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Unit tests for how init.py renders helm values and parses arguments. These
+# don't need a cluster, or anything other than the standard library.
+
+import os
+import sys
+import argparse
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import init
+
+SECRET = "ab" * 32
+
+def valid_values():
+    return init.render_values([
+        init.base_values("1.2.3"),
+        init.auth_values(SECRET, "", None),
+        init.proxy_values(SECRET, "", ""),
+    ])
+
+class DeepMergeTest(unittest.TestCase):
+    def test_merges_dicts_recursively(self):
+        base = {"hub": {"image": {"name": "a", "tag": "1"}, "cpu": 1}}
+        override = {"hub": {"image": {"tag": "2"}}}
+        self.assertEqual(init.deep_merge(base, override), {"hub": {"image": {"name": "a", "tag": "2"}, "cpu": 1}})
+
+    def test_replaces_lists_and_scalars(self):
+        base = {"users": ["a", "b"], "x": {"y": 1}}
+        override = {"users": ["c"], "x": 2}
+        self.assertEqual(init.deep_merge(base, override), {"users": ["c"], "x": 2})
+
+    def test_leaves_inputs_unchanged(self):
+        base = {"hub": {"image": {"tag": "1"}}}
+        init.deep_merge(base, {"hub": {"image": {"tag": "2"}}})
+        self.assertEqual(base, {"hub": {"image": {"tag": "1"}}})
+
+    def test_later_layers_take_precedence(self):
+        self.assertEqual(init.render_values([{"a": 1, "b": 1}, {"b": 2}, {"b": 3, "c": 3}]), {"a": 1, "b": 3, "c": 3})
+
+class DumpValuesTest(unittest.TestCase):
+    def test_nested_values(self):
+        values = {"hub": {"image": {"name": "a", "tag": "1.2"}}, "users": ["x", "y"], "empty": {}}
+        self.assertEqual(init.dump_values(values), "\n".join([
+            "hub:",
+            "  image:",
+            '    name: "a"',
+            '    tag: "1.2"',
+            'users: ["x", "y"]',
+            "empty: {}",
+        ]))
+
+    def test_quotes_keys_that_are_not_plain(self):
+        self.assertEqual(init.dump_values({"a b": 1, "80": 2, "x.y-z_1": 3}), '"a b": 1\n"80": 2\nx.y-z_1: 3')
+
+    def test_quotes_reserved_scalar_keys(self):
+        for key in ["on", "off", "yes", "no", "y", "n", "true", "False", "NULL"]:
+            self.assertEqual(init.dump_values({key: 1}), '"{}": 1'.format(key))
+
+    def test_is_deterministic(self):
+        self.assertEqual(init.dump_values({"a": {"d": 1, "c": {"x": [2, 1]}}}), init.dump_values({"a": {"d": 1, "c": {"x": [2, 1]}}}))
+        self.assertEqual(init.dump_values({"a": {"d": 1, "c": {"x": [2, 1]}}}), "a:\n  d: 1\n  c:\n    x: [2, 1]")
+
+class ValidateValuesTest(unittest.TestCase):
+    def assertInvalid(self, values, *messages):
+        with self.assertRaises(init.ApplicationError) as cm:
+            init.validate_values(values)
+        for message in messages:
+            self.assertIn(message, str(cm.exception))
+
+    def test_accepts_generated_values(self):
+        init.validate_values(valid_values())
+
+    def test_rejects_non_string_keys(self):
+        values = init.deep_merge(valid_values(), {"hub": {True: 1, "ports": [{80: "http"}]}})
+        self.assertInvalid(values, "hub has a key that isn't a string: True", "hub.ports[0] has a key that isn't a string: 80")
+
+    def test_rejects_numeric_image_tags(self):
+        values = init.deep_merge(valid_values(), {"hub": {"image": {"tag": 1.2}}})
+        self.assertInvalid(values, "hub.image.tag must be a non-empty string (use --set-string")
+
+    def test_rejects_bad_secrets(self):
+        values = init.deep_merge(valid_values(), {"proxy": {"secretToken": "short"}, "auth": {"state": {"cryptoKey": "nothex"}}})
+        self.assertInvalid(values, "proxy.secretToken must be 32 hex-encoded bytes", "auth.state.cryptoKey must be 32 hex-encoded bytes")
+
+    def test_rejects_https_without_email(self):
+        values = init.deep_merge(valid_values(), {"proxy": {"https": {"hosts": ["example.com"]}}})
+        self.assertInvalid(values, "proxy.https.letsencrypt.contactEmail must be set")
+
+    def test_rejects_bad_admin_users(self):
+        values = init.deep_merge(valid_values(), {"auth": {"admin": {"users": ["ok", ""]}}})
+        self.assertInvalid(values, "auth.admin.users must be a list of usernames")
+
+class ParseSetValueTest(unittest.TestCase):
+    def test_parses_json_values(self):
+        self.assertEqual(init.parse_set_value("hub.cpu.limit=1.5"), {"hub": {"cpu": {"limit": 1.5}}})
+        self.assertEqual(init.parse_set_value("a=true"), {"a": True})
+        self.assertEqual(init.parse_set_value('a=["x"]'), {"a": ["x"]})
+
+    def test_falls_back_to_strings(self):
+        self.assertEqual(init.parse_set_value("hub.image.tag=1.2.3"), {"hub": {"image": {"tag": "1.2.3"}}})
+        self.assertEqual(init.parse_set_value("a=b=c"), {"a": "b=c"})
+        self.assertEqual(init.parse_set_value("a="), {"a": ""})
+
+    def test_as_string(self):
+        self.assertEqual(init.parse_set_value("hub.image.tag=1.2", as_string=True), {"hub": {"image": {"tag": "1.2"}}})
+        self.assertEqual(init.parse_set_value("a=true", as_string=True), {"a": "true"})
+
+    def test_rejects_settings_without_a_key(self):
+        for setting in ["novalue", "=1"]:
+            with self.assertRaises(init.ApplicationError):
+                init.parse_set_value(setting)
+
+    def test_set_string_takes_precedence(self):
+        overrides = init.load_overrides([], ["hub.image.tag=1.2"], ["hub.image.tag=1.2"])
+        values = init.render_values([valid_values(), *overrides])
+        self.assertEqual(values["hub"]["image"]["tag"], "1.2")
+        init.validate_values(values)
+
+class RenderOnlyTest(unittest.TestCase):
+    def test_renders_overrides(self):
+        rendered = init.render_only("1.2.3", "", "", [init.parse_set_value("singleuser.image.tag=4.5", as_string=True), {"hub": {"extraConfig": {"on": "x"}}}])
+        self.assertIn('    tag: "4.5"', rendered)
+        self.assertIn('    "on": "x"', rendered)
+
+class PositiveIntTest(unittest.TestCase):
+    def test_parses_positive_ints(self):
+        self.assertEqual(init.positive_int("4"), 4)
+
+    def test_rejects_everything_else(self):
+        for value in ["0", "-1", "1.5", "x"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                init.positive_int(value)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,6 +51,9 @@ function reset_minikube {
     ./etc/start_minikube.sh
 }
 
+print_section "Test init.py"
+make test-init
+
 # Make an initial deployment of pachyderm
 print_section "Deploy pachyderm"
 reset_minikube
@@ -96,7 +99,7 @@ case "${VARIANT}" in
 
         # Undeploy jupyterhub
         print_section "Undeploy"
-        ./delete.sh
+        python3.7 init.py --teardown
 
         # Reset minikube fully and re-run the deployment/test cycle. This
         # ensures that jupyterhub doesn't mistakenly pull in its old PV.
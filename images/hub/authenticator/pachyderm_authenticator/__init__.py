@@ -1,8 +1,41 @@
-from traitlets import Unicode
+import os
+import sys
+import copy
+import json
+import time
+import uuid
+import hashlib
+import importlib
+import threading
+import collections
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from traitlets import Unicode, Float, Integer
 from jupyterhub.auth import Authenticator
+from jupyterhub.handlers.login import LogoutHandler
+
+from tornado import gen, web
+from tornado.ioloop import IOLoop, PeriodicCallback
 
-from tornado import gen
-import python_pachyderm
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .metrics import (
+    CACHE_LOOKUP_TOTAL,
+    CIRCUIT_BREAKER_STATE,
+    CIRCUIT_BREAKER_STATE_VALUES,
+    PRE_SPAWN_START_DURATION_SECONDS,
+    RPC_DURATION_SECONDS,
+    RPC_TOTAL,
+    RPCS_IN_FLIGHT,
+    SPAWN_STAGE_DURATION_SECONDS,
+    STATUS_CACHE_AGE_SECONDS,
+    Cache,
+    CacheResult,
+    SpawnOutcome,
+    SpawnStage,
+    rpc_outcome,
+)
+from .spawn_timeline import SpawnTimeline, log_event
 
 MISCONFIGURATION_HTML = """
 <h1>Misconfiguration</h1>
@@ -21,6 +54,102 @@ ENTERPRISE_EXPIRED_HTML = """
 <div>Your enterprise license is expired. Please re-activate before using jupyterhub-pachyderm.</div>
 """
 
+# pachctl in user pods is configured through a config file that kubernetes
+# populates from a pod annotation, via a downward API volume
+PACHCTL_CONFIG_ANNOTATION = "pachyderm.io/pachctl-config"
+PACHCTL_CONFIG_VOLUME = "pachctl-config"
+PACHCTL_CONFIG_DIR = "/etc/pachyderm"
+PACHCTL_CONFIG_FILE = "config.json"
+PACHCTL_CONTEXT = "in-cluster"
+
+# Each spawn gets an ID, which is logged with its stage timings and passed on
+# to the user's pod, so that the pod can be matched up with them
+SPAWN_ID_ANNOTATION = "pachyderm.io/spawn-id"
+SPAWN_ID_ENV = "PACH_SPAWN_ID"
+
+# JupyterHub doesn't tell authenticators how a spawn progresses after
+# `pre_spawn_start`, so the spawner is polled at this interval (in seconds),
+# which bounds the resolution of the later stages' timings
+SPAWN_POLL_INTERVAL = 0.5
+
+# The stage in progress when `pre_spawn_start` fails, keyed by the last
+# stage it marked
+PRE_SPAWN_NEXT_STAGE = {
+    None: SpawnStage.auth_state,
+    SpawnStage.auth_state: SpawnStage.session_check,
+    SpawnStage.session_check: SpawnStage.configure,
+    SpawnStage.configure: SpawnStage.warm_pool_claim,
+    SpawnStage.warm_pool_claim: SpawnStage.pod_start,
+}
+
+# Names of gRPC status codes that indicate pachd couldn't be reached or
+# didn't respond in time, rather than that it rejected a request
+TRANSIENT_STATUS_CODES = (
+    "CANCELLED",
+    "DEADLINE_EXCEEDED",
+    "RESOURCE_EXHAUSTED",
+    "UNAVAILABLE",
+)
+
+# Serializes the first import of the lazily imported modules.
+# python_pachyderm has circular imports, so importing it from two threads at
+# once can leave one of them with a partially initialized module.
+_IMPORT_LOCK = threading.Lock()
+
+class _LazyModule:
+    """
+    Stands in for a module that's imported the first time one of its
+    attributes is accessed.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """Imports the module, if it hasn't been already, and returns it"""
+        if self._module is None:
+            with _IMPORT_LOCK:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+# python_pachyderm pulls in gRPC and every generated protobuf module, which
+# takes a while. Nothing needs it until the first RPC, so it's imported
+# lazily rather than slowing down Hub startup.
+grpc = _LazyModule("grpc")
+python_pachyderm = _LazyModule("python_pachyderm")
+
+def rpc_errors():
+    """
+    Returns the exception types raised by failed RPCs, for except clauses on
+    the event loop. An RPC can only have failed once grpc is imported, so
+    unlike `python_pachyderm.RpcError`, this never imports it.
+    """
+    module = sys.modules.get("grpc")
+    return () if module is None else (module.RpcError,)
+
+class PachydermLogoutHandler(LogoutHandler):
+    """
+    Logs a user out, and stops checking their Pachyderm session token in
+    the background
+    """
+
+    @gen.coroutine
+    def get(self):
+        user = self.get_current_user()
+        if user:
+            self.authenticator.untrack_user_session(user.name)
+
+        # this is a coroutine on JupyterHub >= 1.0
+        result = super().get()
+        if result is not None:
+            yield result
+
+
 class PachydermAuthenticator(Authenticator):
     # The Pachyderm auth token used for check if auth is enabled and
     # authenticating credentials
@@ -30,18 +159,335 @@ class PachydermAuthenticator(Authenticator):
         help="Pachyderm auth token. Leave blank if Pachyderm auth is not enabled."
     )
 
+    # pachd RPCs are blocking, so they're run on a thread pool rather than
+    # on the Hub's event loop
+    rpc_threadpool_workers = Integer(
+        4,
+        config=True,
+        help="Number of threads used for pachd RPCs. This bounds the number of RPCs the authenticator makes concurrently."
+    )
+
+    rpc_timeout = Float(
+        10,
+        config=True,
+        help="Seconds to wait for a pachd RPC to complete before giving up. This is applied as the gRPC deadline of each call."
+    )
+
+    # When pachd is down or overloaded, a circuit breaker fails RPCs fast
+    # rather than having every request wait out its deadline
+    breaker_failure_threshold = Integer(
+        5,
+        config=True,
+        help="Number of consecutive failed or slow pachd RPCs after which the circuit breaker opens, and pachd RPCs fail immediately."
+    )
+
+    breaker_slow_call_threshold = Float(
+        5,
+        config=True,
+        help="Seconds after which a pachd RPC counts as failed for the purposes of the circuit breaker, even if it succeeds."
+    )
+
+    breaker_reset_timeout = Float(
+        30,
+        config=True,
+        help="Seconds that the circuit breaker stays open before letting probe RPCs through to check whether pachd has recovered."
+    )
+
+    breaker_half_open_probes = Integer(
+        1,
+        config=True,
+        help="Number of concurrent probe RPCs let through while checking whether pachd has recovered."
+    )
+
+    # The cluster status shown on the login page is cached, so that page
+    # renders don't each make round trips to pachd
+    status_cache_ttl = Float(
+        30,
+        config=True,
+        help="Seconds that a cluster status check is served from cache before it is refreshed in the background."
+    )
+
+    status_cache_max_stale = Float(
+        300,
+        config=True,
+        help="Seconds that the last known cluster status may be served while refreshes fail. Past this, the login page shows the default login pane until the cluster status is refreshed."
+    )
+
+    # Credentials that pachd rejected are remembered for a short while, so
+    # that retry storms don't each make a round trip to pachd
+    rejected_credentials_ttl = Float(
+        10,
+        config=True,
+        help="Seconds that credentials rejected by pachd are remembered. Logins with remembered credentials fail without contacting pachd."
+    )
+
+    rejected_credentials_max = Integer(
+        1024,
+        config=True,
+        help="Maximum number of rejected credentials to remember."
+    )
+
+    # Users' session tokens are checked periodically in the background, so
+    # that expired sessions are caught before they're used to spawn a pod
+    token_sweep_interval = Float(
+        300,
+        config=True,
+        help="Seconds between background checks of users' Pachyderm session tokens. Set to 0 to disable the background checks."
+    )
+
+    token_sweep_concurrency = Integer(
+        4,
+        config=True,
+        help="Maximum number of session tokens checked concurrently during a background check."
+    )
+
+    token_renew_ttl = Integer(
+        0,
+        config=True,
+        help="If set, session tokens that would otherwise expire before the next background check are extended to this many seconds. This requires `pach_auth_token` to belong to a cluster admin."
+    )
+
+    # Idle user pods can be kept running ahead of time, so that spawns claim
+    # one rather than waiting for a new pod to start
+    warm_pool_size = Integer(
+        0,
+        config=True,
+        help="Number of idle user pods to keep running, ready to be claimed by spawns. This requires the spawner class to be `pachyderm_authenticator.warm_pool.WarmPoolSpawner`. Set to 0 to disable the warm pool."
+    )
+
+    warm_pool_refill_interval = Float(
+        15,
+        config=True,
+        help="Seconds between background checks that top up the warm pool. The pool is also topped up after every claim."
+    )
+
+    warm_up_delay = Float(
+        5,
+        config=True,
+        help="Seconds after the Hub starts to import python_pachyderm and check the cluster status in the background, so that the first login and login page don't pay for them. Set to a negative value to do them on first use instead."
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=self.rpc_threadpool_workers)
+        # The number of RPCs submitted to the executor that haven't completed
+        self.rpcs_in_flight = 0
+        self.breaker = CircuitBreaker(
+            self.log,
+            failure_threshold=self.breaker_failure_threshold,
+            slow_call_threshold=self.breaker_slow_call_threshold,
+            reset_timeout=self.breaker_reset_timeout,
+            half_open_probes=self.breaker_half_open_probes,
+            on_state_change=lambda state: CIRCUIT_BREAKER_STATE.set(CIRCUIT_BREAKER_STATE_VALUES[state]),
+        )
+        # The long-lived client bound to `pach_auth_token`, and the gRPC
+        # channel it shares with every other client. These are created
+        # lazily, since pachd may not be reachable when the Hub starts.
+        self._admin_client = None
+        self._channel_lock = threading.Lock()
+        self.channel_state = None
+        # A tuple of (custom html, fetch time) from the last successful
+        # cluster status check, or `None` if there hasn't been one yet
+        self._status = None
+        # The in-flight background refresh of `_status`, if any
+        self._status_refresh = None
+        # In-flight credential verifications, keyed by credential hash
+        self._verifications = {}
+        # Maps the hashes of recently rejected credentials to when they
+        # should be forgotten, oldest first
+        self._rejected_credentials = collections.OrderedDict()
+
+        # Users' current session tokens, keyed by their hash. Each is a dict
+        # holding the token, the user it belongs to, whether it's valid (or
+        # `None` if that isn't known yet), when that was last checked, and
+        # when the token was last used.
+        self._sessions = {}
+        # Maps usernames to the hash of their current session token
+        self._user_sessions = {}
+        self._sweeping = False
+
+        # NaN until the status is first fetched, so that it isn't mistaken
+        # for a fresh one
+        STATUS_CACHE_AGE_SECONDS.set_function(lambda: float("nan") if self.status_cache_age is None else self.status_cache_age)
+
+        if self.token_sweep_interval > 0:
+            self._session_sweeper = PeriodicCallback(self.sweep_sessions, self.token_sweep_interval * 1000)
+            self._session_sweeper.start()
+
+        self.warm_pool = None
+        if self.warm_pool_size > 0:
+            # This needs kubespawner, which the authenticator otherwise
+            # doesn't
+            from .warm_pool import WarmPool
+            self.warm_pool = WarmPool(self.log, self.warm_pool_size)
+            self._warm_pool_refiller = PeriodicCallback(self.warm_pool.refill, self.warm_pool_refill_interval * 1000)
+            self._warm_pool_refiller.start()
+
+        if self.warm_up_delay >= 0:
+            IOLoop.current().call_later(self.warm_up_delay, self.refresh_cluster_status, True)
+
+    def warm_up(self):
+        """
+        Imports python_pachyderm, then checks the cluster status. This runs
+        on the executor, so that the first login and login page render don't
+        wait for either.
+        """
+        python_pachyderm.load()
+        return self.fetch_cluster_status()
+
+    @property
+    def admin_client(self):
+        """
+        The Pachyderm client bound to `pach_auth_token`. It's created on
+        first use, and reused for the lifetime of the Hub.
+        """
+        with self._channel_lock:
+            if self._admin_client is None:
+                self._admin_client = self._connect()
+            return self._admin_client
+
+    def _connect(self):
+        # python_pachyderm is imported through the lazy module first, so that
+        # the import is serialized with any others
+        python_pachyderm.load()
+        from python_pachyderm.service import Service
+        from .interceptors import DeadlineInterceptor
+
+        client = python_pachyderm.Client.new_in_cluster(auth_token=self.pach_auth_token or None)
+
+        if client.root_certs:
+            credentials = grpc.ssl_channel_credentials(root_certificates=client.root_certs)
+            channel = grpc.secure_channel(client.address, credentials)
+        else:
+            channel = grpc.insecure_channel(client.address)
+
+        # gRPC reconnects a channel on its own (with backoff) when the
+        # connection drops; we just log the transitions
+        channel.subscribe(self._channel_state_changed, try_to_connect=True)
+        channel = grpc.intercept_channel(channel, DeadlineInterceptor(self.rpc_timeout))
+
+        # By default, python_pachyderm lazily opens a separate channel for
+        # each service. Pre-populate its stubs so that every service shares
+        # a single channel.
+        for service in Service:
+            client._stubs[service] = service.stub(channel)
+
+        self.log.info("created a pachd channel to %s", client.address)
+        return client
+
+    def _channel_state_changed(self, state):
+        previous_state, self.channel_state = self.channel_state, state
+
+        if state is grpc.ChannelConnectivity.READY:
+            self.log.info("pachd channel is ready")
+        elif state is grpc.ChannelConnectivity.TRANSIENT_FAILURE:
+            self.log.warning("pachd channel failed; reconnecting")
+        elif state is grpc.ChannelConnectivity.IDLE and previous_state is grpc.ChannelConnectivity.READY:
+            self.log.info("pachd channel went idle; it will reconnect on the next RPC")
+        else:
+            self.log.debug("pachd channel state: %s", state.name)
+
     def pachyderm_client(self, auth_token):
-        """Creates a new Pachyderm client"""
+        """
+        Returns a Pachyderm client that makes requests with the given auth
+        token. The client shares the admin client's gRPC channel; only the
+        auth token sent as call metadata differs.
+        """
+
+        admin_client = self.admin_client
+        if auth_token == admin_client.auth_token:
+            return admin_client
+
+        # The shallow copy shares the stubs (and therefore the channel),
+        # while setting the auth token rebuilds the copy's call metadata
+        client = copy.copy(admin_client)
+        client.auth_token = auth_token
+        return client
+
+    def call_pachd(self, f, *args):
+        """
+        Makes a blocking call to pachd through the circuit breaker. Raises
+        `CircuitOpenError` without making the call if the breaker is open.
+        """
+        rpc = f.__name__
+
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            RPC_TOTAL.labels(rpc=rpc, outcome="circuit-open").inc()
+            raise
+
+        start = time.monotonic()
+        succeeded = False
+        error = None
+
+        try:
+            result = f(*args)
+            succeeded = True
+            return result
+        except grpc.RpcError as e:
+            # pachd rejecting a request still means it's up
+            succeeded = e.code().name not in TRANSIENT_STATUS_CODES
+            error = e
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.monotonic() - start
+            self.breaker.after_call(succeeded, duration)
+            RPC_DURATION_SECONDS.labels(rpc=rpc).observe(duration)
+            RPC_TOTAL.labels(rpc=rpc, outcome=rpc_outcome(error)).inc()
+
+    def run_rpc(self, rpc, *args, auth_token=None):
+        """
+        Runs a single blocking pachd RPC, the client method named `rpc`, on
+        the executor, through the circuit breaker. It's made with
+        `auth_token`, or with `pach_auth_token` if that isn't set.
+        """
+        return self.run_blocking(self._call_rpc, rpc, auth_token, *args)
+
+    def _call_rpc(self, rpc, auth_token, *args):
+        # The client is looked up here rather than on the event loop, since
+        # the first lookup imports python_pachyderm and creates the channel
+        client = self.admin_client if auth_token is None else self.pachyderm_client(auth_token)
+        return self.call_pachd(getattr(client, rpc), *args)
+
+    @gen.coroutine
+    def run_blocking(self, f, *args):
+        """
+        Runs a blocking function that calls pachd on the executor, so that
+        it doesn't block the Hub's event loop. Raises
+        `tornado.gen.TimeoutError` if the function doesn't complete within
+        `rpc_timeout` seconds.
+        """
+        future = self.executor.submit(f, *args)
+        self.rpcs_in_flight += 1
+        RPCS_IN_FLIGHT.inc()
+        self.log.debug("pachd RPCs in flight: %d", self.rpcs_in_flight)
+
+        try:
+            # the gRPC deadline usually fires at about the same time, so
+            # don't log the resulting error. This can't name grpc.RpcError,
+            # which would import grpc on the event loop.
+            result = yield gen.with_timeout(timedelta(seconds=self.rpc_timeout), future, quiet_exceptions=(Exception,))
+        except gen.TimeoutError:
+            # if the call hasn't started yet, don't bother running it
+            future.cancel()
+            raise
+        finally:
+            self.rpcs_in_flight -= 1
+            RPCS_IN_FLIGHT.dec()
 
-        return python_pachyderm.Client.new_in_cluster(auth_token=auth_token)
+        return result
 
-    def is_pachyderm_auth_enabled(self, client):
+    def is_pachyderm_auth_enabled(self):
         """
         Returns whether Pachyderm auth is enabled. Note that if this returns
         `None` (rather than `False`), there is a misconfiguration.
         """
         try:
-            client.who_am_i()
+            self.call_pachd(self.admin_client.who_am_i)
         except python_pachyderm.RpcError as e:
             details = e.details()
 
@@ -59,11 +505,26 @@ class PachydermAuthenticator(Authenticator):
         return True
 
     @property
-    def custom_html(self):
-        client = self.pachyderm_client(self.pach_auth_token or None)
+    def status_cache_age(self):
+        """
+        Returns the number of seconds since the cluster status was last
+        fetched successfully, or `None` if it has never been fetched.
+        """
+        status = self._status
+        if status is None:
+            return None
+        return time.monotonic() - status[1]
+
+    def fetch_cluster_status(self):
+        """
+        Checks the enterprise and auth state of the cluster. Returns the
+        custom HTML to show on the login page, or `None` to show the default
+        login pane.
+        """
+        client = self.admin_client
 
         # Check enterprise state
-        enterprise_state = client.get_enterprise_state().state
+        enterprise_state = self.call_pachd(client.get_enterprise_state).state
         if enterprise_state is python_pachyderm.State.NONE:
             return ENTERPRISE_DISABLED_HTML
         elif enterprise_state is python_pachyderm.State.EXPIRED:
@@ -71,7 +532,7 @@ class PachydermAuthenticator(Authenticator):
         elif enterprise_state is not python_pachyderm.State.ACTIVE:
             return MISCONFIGURATION_HTML
 
-        auth_activated = self.is_pachyderm_auth_enabled(client)
+        auth_activated = self.is_pachyderm_auth_enabled()
         if auth_activated is None:
             # Generate custom HTML to show on the login page if there's a
             # misconfiguration
@@ -84,22 +545,152 @@ class PachydermAuthenticator(Authenticator):
         # show login error messages) because we can only use static HTML.
         return None
 
+    def refresh_cluster_status(self, warm_up=False):
+        """
+        Refreshes the cached cluster status in the background, along with the
+        rest of the warm-up if `warm_up` is set. Does nothing if a refresh is
+        already in flight.
+        """
+        if self._status_refresh is not None or self.breaker.is_open():
+            return
+
+        self._status_refresh = self.run_blocking(self.warm_up if warm_up else self.fetch_cluster_status)
+        IOLoop.current().add_future(self._status_refresh, self._cluster_status_refreshed)
+
+    def _cluster_status_refreshed(self, future):
+        self._status_refresh = None
+
+        try:
+            html = future.result()
+        except Exception:
+            age = self.status_cache_age
+            if age is None:
+                self.log.exception("could not refresh the cluster status; there is no last known status to serve")
+            else:
+                self.log.exception("could not refresh the cluster status; serving the last known status, which is %.0fs old", age)
+            return
+
+        self._status = (html, time.monotonic())
+
+    @property
+    def custom_html(self):
+        age = self.status_cache_age
+
+        if age is None or age > self.status_cache_max_stale:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.cluster_status, result=CacheResult.miss).inc()
+
+            # There's no cached status, or it's too old to trust. Waiting for
+            # pachd here would block the event loop, so the status is checked
+            # in the background, and the default login pane is shown in the
+            # meantime. Logins are verified with pachd either way.
+            self.refresh_cluster_status()
+            return None
+
+        if age > self.status_cache_ttl:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.cluster_status, result=CacheResult.stale).inc()
+            self.refresh_cluster_status()
+        else:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.cluster_status, result=CacheResult.hit).inc()
+
+        return self._status[0]
+
+    def is_rejected_credential(self, key):
+        """
+        Returns whether the credentials with the given hash were recently
+        rejected by pachd.
+        """
+        expires_at = self._rejected_credentials.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._rejected_credentials[key]
+            return False
+        return True
+
+    def add_rejected_credential(self, key):
+        """Remembers that the credentials with the given hash were rejected"""
+        self._rejected_credentials.pop(key, None)
+        self._rejected_credentials[key] = time.monotonic() + self.rejected_credentials_ttl
+        while len(self._rejected_credentials) > self.rejected_credentials_max:
+            self._rejected_credentials.popitem(last=False)
+
     @gen.coroutine
     def authenticate(self, handler, data):
-        client = self.pachyderm_client(self.pach_auth_token or None)
-        auth_activated = self.is_pachyderm_auth_enabled(client)
-        if not auth_activated:
-            # auth check failed due to misconfiguration - bail
+        start = time.monotonic()
+        user = yield self.authenticate_credentials(data)
+
+        duration = time.monotonic() - start
+        SPAWN_STAGE_DURATION_SECONDS.labels(stage=SpawnStage.authenticate).observe(duration)
+        log_event(
+            self.log,
+            "login",
+            user=user["name"] if user else None,
+            success=user is not None,
+            seconds=round(duration, 3),
+        )
+        return user
+
+    @gen.coroutine
+    def authenticate_credentials(self, data):
+        """
+        Checks login credentials, returning the authenticated user or `None`.
+        """
+        # Credentials are identified by their hash, so that they don't linger
+        # in memory
+        key = hashlib.sha256(data["password"].encode("utf8")).hexdigest()
+
+        if self.is_rejected_credential(key):
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.rejected_credentials, result=CacheResult.hit).inc()
+            self.log.error("auth failed: these credentials were recently rejected")
             return
+        CACHE_LOOKUP_TOTAL.labels(cache=Cache.rejected_credentials, result=CacheResult.miss).inc()
+
+        if self.breaker.is_open():
+            self.log.error("auth failed: pachd is unavailable")
+            return
+
+        # Concurrent logins with the same credentials (e.g. from a
+        # double-clicked sign in button) share a single verification
+        future = self._verifications.get(key)
+        if future is None:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.verifications, result=CacheResult.miss).inc()
+            future = self.verify_credentials(data["password"], key)
+            self._verifications[key] = future
+            future.add_done_callback(lambda _: self._verifications.pop(key, None))
+        else:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.verifications, result=CacheResult.hit).inc()
+            self.log.debug("joining an in-flight verification of the same credentials")
+
+        user = yield future
 
+        # JupyterHub modifies the returned user, so each caller gets its own
+        return copy.deepcopy(user)
+
+    @gen.coroutine
+    def verify_credentials(self, password, key):
+        """
+        Verifies credentials with pachd, returning the authenticated user or
+        `None`. If pachd rejects the credentials, they're remembered by their
+        hash, `key`.
+        """
         try:
-            if data["password"].startswith("otp/"):
-                user_auth_token = client.authenticate_one_time_password(data["password"])
-            else:
-                user_auth_token = client.authenticate_github(data["password"])
+            auth_activated = yield self.run_blocking(self.is_pachyderm_auth_enabled)
+            if not auth_activated:
+                # auth check failed due to misconfiguration - bail
+                return
+
+            try:
+                if password.startswith("otp/"):
+                    user_auth_token = yield self.run_rpc("authenticate_one_time_password", password)
+                else:
+                    user_auth_token = yield self.run_rpc("authenticate_github", password)
+            except rpc_errors() as e:
+                if e.code().name not in TRANSIENT_STATUS_CODES:
+                    self.add_rejected_credential(key)
+                raise
 
-            user_client = self.pachyderm_client(user_auth_token)
-            username = user_client.who_am_i().username
+            username = (yield self.run_rpc("who_am_i", auth_token=user_auth_token)).username
+            self.track_session(username, user_auth_token, valid=True)
 
             return {
                 "name": username,
@@ -107,27 +698,305 @@ class PachydermAuthenticator(Authenticator):
                     "token": user_auth_token,
                 }
             }
-        except python_pachyderm.RpcError as e:
+        except rpc_errors() as e:
             self.log.error("auth failed: %s", e)
             return
+        except gen.TimeoutError:
+            self.log.error("auth failed: timed out waiting for pachd")
+            return
+        except CircuitOpenError:
+            self.log.error("auth failed: pachd is unavailable")
+            return
+
+    def track_session(self, username, token, valid=None):
+        """
+        Records that a session token is a user's current one, so that it's
+        checked by the background sweeps, and stops tracking the user's
+        previous token. If `valid` is set, it's recorded as the token's
+        verdict. Returns the session.
+        """
+        key = hashlib.sha256(token.encode("utf8")).hexdigest()
+        previous_key = self._user_sessions.get(username)
+        if previous_key is not None and previous_key != key:
+            self._sessions.pop(previous_key, None)
+
+        session = self._sessions.get(key)
+        if session is None or session["username"] != username:
+            session = self._sessions[key] = {
+                "key": key,
+                "token": token,
+                "username": username,
+                "valid": None,
+                "checked_at": None,
+            }
+        self._user_sessions[username] = key
+        session["seen_at"] = time.monotonic()
+        if valid is not None:
+            session["valid"] = valid
+            session["checked_at"] = time.monotonic()
+        return session
+
+    def untrack_session(self, session):
+        """Stops tracking a session token"""
+        self._sessions.pop(session["key"], None)
+        if self._user_sessions.get(session["username"]) == session["key"]:
+            del self._user_sessions[session["username"]]
+
+    def untrack_user_session(self, username):
+        """Stops tracking a user's current session token, if there is one"""
+        key = self._user_sessions.pop(username, None)
+        if key is not None:
+            self._sessions.pop(key, None)
+
+    def is_current_session(self, session):
+        """Returns whether a session token is still its user's current one"""
+        return self._sessions.get(session["key"]) is session and self._user_sessions.get(session["username"]) == session["key"]
 
     @gen.coroutine
-    def pre_spawn_start(self, user, spawner):
+    def check_session(self, session):
+        """
+        Checks with pachd whether a session's token is still valid, and renews
+        it if it's close to expiring and `token_renew_ttl` is set. Records and
+        returns the verdict, which is left unchanged if pachd couldn't give
+        one.
+        """
+        try:
+            ttl = (yield self.run_rpc("who_am_i", auth_token=session["token"])).ttl
+        except rpc_errors() as e:
+            if e.details() != "provided auth token is corrupted or has expired (try logging in again)":
+                self.log.warning("could not check a session token: %s", e.details())
+                return session["valid"]
+            valid = False
+        except (gen.TimeoutError, CircuitOpenError):
+            return session["valid"]
+        else:
+            valid = True
+            # pachd reports a TTL of zero or less for tokens that don't expire.
+            # Tokens that were replaced or logged out while this was checked
+            # are left to expire.
+            if self.token_renew_ttl and 0 < ttl < 2 * self.token_sweep_interval and self.is_current_session(session):
+                try:
+                    yield self.run_rpc("extend_auth_token", session["token"], self.token_renew_ttl)
+                    self.log.info("renewed a session token that was going to expire in %ds", ttl)
+                except rpc_errors() + (gen.TimeoutError, CircuitOpenError) as e:
+                    self.log.warning("could not renew a session token: %s", e)
+
+        session["valid"] = valid
+        session["checked_at"] = time.monotonic()
+        return valid
+
+    @gen.coroutine
+    def sweep_sessions(self):
+        """
+        Checks every tracked session token, `token_sweep_concurrency` at a
+        time. Tokens that haven't been used since the previous sweep are
+        forgotten first.
+        """
+        if self._sweeping:
+            self.log.warning("skipping a session token sweep, since the previous one hasn't finished")
+            return
+
+        self._sweeping = True
+        start = time.monotonic()
+
+        try:
+            # Tokens that weren't used in a login, spawn or refresh since the
+            # last sweep, or were already invalid as of it, are forgotten;
+            # they'll be tracked again if they're used
+            for session in list(self._sessions.values()):
+                unused = start - session["seen_at"] > self.token_sweep_interval
+                invalid = session["valid"] is False and start - session["checked_at"] > self.token_sweep_interval
+                if unused or invalid:
+                    self.untrack_session(session)
+
+            sessions = [session for session in self._sessions.values() if session["valid"] is not False]
+            batch_size = max(self.token_sweep_concurrency, 1)
+            for i in range(0, len(sessions), batch_size):
+                yield [self.check_session(session) for session in sessions[i:i + batch_size]]
+
+            expired_count = sum(1 for session in sessions if session["valid"] is False)
+            self.log.info("checked %d session tokens in %.2fs; %d have expired", len(sessions), time.monotonic() - start, expired_count)
+        except Exception:
+            self.log.exception("session token sweep failed")
+        finally:
+            self._sweeping = False
+
+    @gen.coroutine
+    def is_session_valid(self, username, token):
+        """
+        Returns whether a user's session token is valid, as of the last
+        background check. Tokens that haven't been checked yet are checked
+        now. If pachd can't be reached, the token is assumed to be valid.
+        """
+        session = self.track_session(username, token)
+        if session["valid"] is None:
+            yield self.check_session(session)
+        return session["valid"] is not False
+
+    @gen.coroutine
+    def refresh_user(self, user, handler=None):
         auth_state = yield user.get_auth_state()
 
         if not auth_state:
-            return
+            return True
+
+        valid = yield self.is_session_valid(user.name, auth_state["token"])
+        if not valid:
+            self.log.warning("the Pachyderm session for %s has expired; they must log in again", user.name)
+        return valid
 
-        token = auth_state["token"]
+    def get_handlers(self, app):
+        # these take precedence over JupyterHub's own handlers
+        return [("/logout", PachydermLogoutHandler)] + super().get_handlers(app)
 
-        spawner.environment.update({
-            "PACH_PYTHON_AUTH_TOKEN": token,
+    def pachctl_config(self, username, token):
+        """
+        Returns the pachctl config for a user's pod, as JSON. It has a single,
+        active context that connects to the in-cluster pachd with the given
+        session token.
+        """
+        return json.dumps({
+            # pachctl uses this to identify the user in its metrics; derive it
+            # from the username so it's stable across spawns
+            "user_id": uuid.uuid5(uuid.NAMESPACE_URL, username).hex,
+            "v2": {
+                "active_context": PACHCTL_CONTEXT,
+                "contexts": {
+                    PACHCTL_CONTEXT: {
+                        "pachd_address": "{}:{}".format(os.environ["PACHD_SERVICE_HOST"], os.environ["PACHD_SERVICE_PORT"]),
+                        "session_token": token,
+                    },
+                },
+                "metrics": True,
+            },
         })
 
-        spawner.lifecycle_hooks = {
-            "postStart": {
-                "exec": {
-                    "command": ["/app/config.sh", token]
-                }
-            }
-        }
+    @gen.coroutine
+    def claim_warm_pod(self, spawner):
+        """
+        Claims a pod from the warm pool for a spawn, and pushes the user's
+        environment and pachctl config into it. If there's no suitable idle
+        pod, the spawner starts a new one as usual.
+        """
+        template = yield spawner.get_warm_pod_template()
+        if template is None:
+            self.log.debug("the server for %s can't come from the warm pool, since its pod spec depends on the user", spawner.user.name)
+            return
+
+        (template_hash, manifest, script) = template
+        self.warm_pool.set_template(spawner.namespace, template_hash, manifest)
+
+        try:
+            name = yield self.warm_pool.claim(script)
+        except Exception:
+            self.log.exception("could not claim a warm pool pod")
+            name = None
+
+        # Replaces the claimed pod, or fills the pool for the first time
+        IOLoop.current().spawn_callback(self.warm_pool.refill)
+
+        if name is None:
+            CACHE_LOOKUP_TOTAL.labels(cache=Cache.warm_pool, result=CacheResult.miss).inc()
+            self.log.info("no warm pool pods are available for %s; starting a new pod", spawner.user.name)
+            return
+        CACHE_LOOKUP_TOTAL.labels(cache=Cache.warm_pool, result=CacheResult.hit).inc()
+        self.log.info("claimed warm pool pod %s for %s", name, spawner.user.name)
+        spawner.warm_pod_name = name
+
+    @gen.coroutine
+    def watch_spawn(self, spawner, timeline):
+        """
+        Follows a spawn after `pre_spawn_start` until the server is ready or
+        the spawn fails, marking the stages the spawner goes through on
+        `timeline`.
+        """
+        pod_started = False
+        while spawner.pending == "spawn":
+            # JupyterHub sets this once `spawner.start()` returns, while it
+            # waits for the server to respond
+            if not pod_started and spawner._waiting_for_response:
+                timeline.mark(SpawnStage.pod_start)
+                pod_started = True
+            yield gen.sleep(SPAWN_POLL_INTERVAL)
+
+        if not spawner.ready:
+            if timeline.failed_stage is not None:
+                stage = timeline.failed_stage
+            elif pod_started:
+                stage = SpawnStage.server_start
+            else:
+                stage = SpawnStage.pod_start
+            timeline.finish(SpawnOutcome.failed, stage)
+            return
+        if not pod_started:
+            timeline.mark(SpawnStage.pod_start)
+        timeline.mark(SpawnStage.server_start)
+        timeline.finish(SpawnOutcome.ready)
+
+    @gen.coroutine
+    def pre_spawn_start(self, user, spawner):
+        with PRE_SPAWN_START_DURATION_SECONDS.time():
+            timeline = SpawnTimeline(self.log, user.name)
+            spawner.pachyderm_spawn_timeline = timeline
+            IOLoop.current().spawn_callback(self.watch_spawn, spawner, timeline)
+
+            try:
+                spawner.environment[SPAWN_ID_ENV] = timeline.spawn_id
+                spawner.extra_annotations = dict(spawner.extra_annotations)
+                spawner.extra_annotations[SPAWN_ID_ANNOTATION] = timeline.spawn_id
+
+                auth_state = yield user.get_auth_state()
+                timeline.mark(SpawnStage.auth_state)
+
+                if not auth_state:
+                    return
+
+                token = auth_state["token"]
+
+                # `refresh_user` normally catches expired sessions before a spawn,
+                # but JupyterHub < 1.0 doesn't call it
+                valid = yield self.is_session_valid(user.name, token)
+                if not valid:
+                    raise web.HTTPError(403, "Your Pachyderm session has expired. Please log out, and log back in.")
+                timeline.mark(SpawnStage.session_check)
+
+                config = self.pachctl_config(user.name, token)
+
+                spawner.environment.update({
+                    "PACH_PYTHON_AUTH_TOKEN": token,
+                    "PACH_CONFIG": os.path.join(PACHCTL_CONFIG_DIR, PACHCTL_CONFIG_FILE),
+                })
+
+                # KubeSpawner expands `{username}`-style templates in annotations,
+                # so braces in the config have to be escaped
+                spawner.extra_annotations[PACHCTL_CONFIG_ANNOTATION] = config.replace("{", "{{").replace("}", "}}")
+
+                # The spawner is reused across spawns, so replace rather than
+                # append to the volumes from any previous spawn
+                spawner.volumes = [v for v in spawner.volumes if v.get("name") != PACHCTL_CONFIG_VOLUME] + [{
+                    "name": PACHCTL_CONFIG_VOLUME,
+                    "downwardAPI": {
+                        "items": [{
+                            "path": PACHCTL_CONFIG_FILE,
+                            "fieldRef": {
+                                "fieldPath": "metadata.annotations['{}']".format(PACHCTL_CONFIG_ANNOTATION),
+                            },
+                        }],
+                    },
+                }]
+                spawner.volume_mounts = [m for m in spawner.volume_mounts if m.get("name") != PACHCTL_CONFIG_VOLUME] + [{
+                    "name": PACHCTL_CONFIG_VOLUME,
+                    "mountPath": PACHCTL_CONFIG_DIR,
+                    "readOnly": True,
+                }]
+
+                timeline.mark(SpawnStage.configure)
+
+                if self.warm_pool is not None and hasattr(spawner, "get_warm_pod_template"):
+                    yield self.claim_warm_pod(spawner)
+                    timeline.mark(SpawnStage.warm_pool_claim)
+            except Exception:
+                # `watch_spawn` reports the failure once JupyterHub gives up
+                # on the spawn, but can't tell which stage was in progress
+                timeline.failed_stage = PRE_SPAWN_NEXT_STAGE[timeline.last_stage]
+                raise
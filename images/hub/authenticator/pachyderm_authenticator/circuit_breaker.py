@@ -0,0 +1,105 @@
+import time
+import threading
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit breaker is open"""
+    pass
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker. After `failure_threshold` consecutive
+    failed (or slower than `slow_call_threshold`) calls, the breaker opens
+    and rejects calls outright. Once `reset_timeout` seconds have passed, it
+    goes half-open and lets up to `half_open_probes` concurrent calls
+    through: it closes again if a probe succeeds, and re-opens if one fails.
+
+    If set, `on_state_change` is called with the new state on every
+    transition.
+    """
+
+    def __init__(self, log, failure_threshold, slow_call_threshold, reset_timeout, half_open_probes, on_state_change=None):
+        self.log = log
+        self.failure_threshold = failure_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.on_state_change = on_state_change
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """
+        Returns whether calls are currently being rejected, without
+        reserving a probe.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at < self.reset_timeout
+            elif self.state == HALF_OPEN:
+                return self.probes_in_flight >= self.half_open_probes
+            return False
+
+    def before_call(self):
+        """
+        Must be called before each call. Raises `CircuitOpenError` if the
+        call should not be made.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("circuit breaker is open")
+                self._transition(HALF_OPEN)
+
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= self.half_open_probes:
+                    raise CircuitOpenError("circuit breaker is half-open, and waiting on probes")
+                self.probes_in_flight += 1
+
+    def after_call(self, succeeded, duration):
+        """
+        Must be called after each call that `before_call` let through,
+        with whether it succeeded and how long it took in seconds.
+        """
+        failed = not succeeded or duration > self.slow_call_threshold
+
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight = max(self.probes_in_flight - 1, 0)
+                if failed:
+                    self._transition(OPEN)
+                else:
+                    self._transition(CLOSED)
+            elif self.state == CLOSED:
+                if failed:
+                    self.consecutive_failures += 1
+                    if self.consecutive_failures >= self.failure_threshold:
+                        self._transition(OPEN)
+                else:
+                    self.consecutive_failures = 0
+            # calls that were let through before the breaker opened don't
+            # change anything
+
+    def _transition(self, state):
+        previous_state, self.state = self.state, state
+
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+            self.log.warning("pachd circuit breaker opened (was %s); failing pachd RPCs fast for %.0fs", previous_state, self.reset_timeout)
+        elif state == HALF_OPEN:
+            self.probes_in_flight = 0
+            self.log.info("pachd circuit breaker is half-open; probing pachd")
+        else:
+            self.consecutive_failures = 0
+            self.log.info("pachd circuit breaker closed; pachd has recovered")
+
+        if self.on_state_change is not None:
+            self.on_state_change(state)
@@ -0,0 +1,30 @@
+"""
+gRPC interceptors for the channel to pachd. These are kept apart from the
+authenticator so that gRPC isn't imported until the channel is created.
+"""
+import collections
+
+import grpc
+
+class _ClientCallDetails(
+        collections.namedtuple("_ClientCallDetails", ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression")),
+        grpc.ClientCallDetails):
+    pass
+
+class DeadlineInterceptor(grpc.UnaryUnaryClientInterceptor):
+    """Applies a default deadline to unary gRPC calls that don't set one"""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        if client_call_details.timeout is None:
+            client_call_details = _ClientCallDetails(
+                client_call_details.method,
+                self.timeout,
+                client_call_details.metadata,
+                client_call_details.credentials,
+                getattr(client_call_details, "wait_for_ready", None),
+                getattr(client_call_details, "compression", None),
+            )
+        return continuation(client_call_details, request)
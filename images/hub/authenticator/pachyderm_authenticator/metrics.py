@@ -0,0 +1,173 @@
+"""
+Prometheus metrics exported by the Pachyderm authenticator
+
+These are registered on prometheus_client's default registry, the same one
+JupyterHub uses, so they're served alongside the Hub's own metrics on
+`/hub/metrics`. Naming follows JupyterHub's conventions
+(`<noun>_<verb>_<type_suffix>`), with a `pachyderm_authenticator_` prefix.
+"""
+from enum import Enum
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from . import circuit_breaker
+
+RPC_DURATION_SECONDS = Histogram(
+    'pachyderm_authenticator_rpc_duration_seconds',
+    'time taken by pachd RPCs made by the authenticator',
+    ['rpc']
+)
+
+RPC_TOTAL = Counter(
+    'pachyderm_authenticator_rpc_total',
+    'pachd RPCs made by the authenticator, by outcome',
+    ['rpc', 'outcome']
+)
+
+RPCS_IN_FLIGHT = Gauge(
+    'pachyderm_authenticator_rpcs_in_flight',
+    'pachd RPCs submitted to the authenticator\'s thread pool that have not completed'
+)
+
+PRE_SPAWN_START_DURATION_SECONDS = Histogram(
+    'pachyderm_authenticator_pre_spawn_start_duration_seconds',
+    'time taken by the authenticator\'s pre_spawn_start hook'
+)
+
+SPAWN_STAGE_DURATION_SECONDS = Histogram(
+    'pachyderm_authenticator_spawn_stage_duration_seconds',
+    'time taken by each stage of logging in and spawning a user\'s server',
+    ['stage'],
+    # Pod starts include scheduling and image pulls, so these go well past
+    # prometheus_client's default buckets
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf"))
+)
+
+SPAWN_TOTAL = Counter(
+    'pachyderm_authenticator_spawn_total',
+    'spawns followed by the authenticator, by outcome',
+    ['outcome']
+)
+
+CACHE_LOOKUP_TOTAL = Counter(
+    'pachyderm_authenticator_cache_lookup_total',
+    'lookups in the authenticator\'s caches, by result',
+    ['cache', 'result']
+)
+
+WARM_POOL_IDLE_PODS = Gauge(
+    'pachyderm_authenticator_warm_pool_idle_pods',
+    'idle pods in the warm pool that are ready to be claimed, as of the last refill'
+)
+
+STATUS_CACHE_AGE_SECONDS = Gauge(
+    'pachyderm_authenticator_status_cache_age_seconds',
+    'seconds since the cluster status shown on the login page was last fetched, or NaN if it has never been fetched'
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    'pachyderm_authenticator_circuit_breaker_state',
+    'state of the circuit breaker around pachd RPCs (0 = closed, 1 = half-open, 2 = open)'
+)
+
+# Values of CIRCUIT_BREAKER_STATE for each circuit breaker state
+CIRCUIT_BREAKER_STATE_VALUES = {
+    circuit_breaker.CLOSED: 0,
+    circuit_breaker.HALF_OPEN: 1,
+    circuit_breaker.OPEN: 2,
+}
+
+# Well-known pachd errors, mapped to the 'outcome' label of RPC_TOTAL. Other
+# errors are labelled by their gRPC status code, so that arbitrary error
+# details don't create unbounded label values.
+RPC_ERROR_OUTCOMES = {
+    "the auth service is not activated": "auth-not-activated",
+    "no authentication token (try logging in)": "no-auth-token",
+    "provided auth token is corrupted or has expired (try logging in again)": "bad-auth-token",
+}
+
+class Cache(Enum):
+    """
+    Possible values for the 'cache' label of CACHE_LOOKUP_TOTAL
+    """
+    cluster_status = 'cluster-status'
+    rejected_credentials = 'rejected-credentials'
+    verifications = 'verifications'
+    warm_pool = 'warm-pool'
+
+    def __str__(self):
+        return self.value
+
+class CacheResult(Enum):
+    """
+    Possible values for the 'result' label of CACHE_LOOKUP_TOTAL
+    """
+    hit = 'hit'
+    stale = 'stale'
+    miss = 'miss'
+
+    def __str__(self):
+        return self.value
+
+class SpawnStage(Enum):
+    """
+    Possible values for the 'stage' label of SPAWN_STAGE_DURATION_SECONDS
+    """
+    # Verifying a user's credentials with pachd when they log in
+    authenticate = 'authenticate'
+    # Loading the user's auth state, in `pre_spawn_start`
+    auth_state = 'auth-state'
+    # Checking that the user's Pachyderm session is still valid
+    session_check = 'session-check'
+    # Generating the pachctl config and configuring the spawner
+    configure = 'configure'
+    # Claiming a pod from the warm pool, and pushing the user's config into it
+    warm_pool_claim = 'warm-pool-claim'
+    # `spawner.start()`: scheduling the pod, pulling its image and starting
+    # its containers, or adopting a claimed warm pool pod
+    pod_start = 'pod-start'
+    # Waiting for the started server to respond
+    server_start = 'server-start'
+
+    def __str__(self):
+        return self.value
+
+class SpawnOutcome(Enum):
+    """
+    Possible values for the 'outcome' label of SPAWN_TOTAL
+    """
+    ready = 'ready'
+    failed = 'failed'
+
+    def __str__(self):
+        return self.value
+
+for c in Cache:
+    for r in CacheResult:
+        # Create empty metrics with the given labels
+        CACHE_LOOKUP_TOTAL.labels(cache=c, result=r)
+
+for s in SpawnStage:
+    SPAWN_STAGE_DURATION_SECONDS.labels(stage=s)
+
+for o in SpawnOutcome:
+    SPAWN_TOTAL.labels(outcome=o)
+
+def rpc_outcome(error):
+    """
+    Returns the 'outcome' label of RPC_TOTAL for an RPC that raised
+    `error`, or that succeeded if `error` is `None`. Errors other than gRPC
+    errors, e.g. from failing to connect, are labelled "error".
+    """
+    if error is None:
+        return "success"
+
+    # gRPC errors raised by calls have both of these methods; the base
+    # `grpc.RpcError` doesn't
+    if not (callable(getattr(error, "details", None)) and callable(getattr(error, "code", None))):
+        return "error"
+
+    details = error.details()
+    if details in RPC_ERROR_OUTCOMES:
+        return RPC_ERROR_OUTCOMES[details]
+    return error.code().name.lower()
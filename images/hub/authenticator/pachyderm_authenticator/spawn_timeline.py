@@ -0,0 +1,63 @@
+import json
+import time
+import uuid
+
+from .metrics import SPAWN_STAGE_DURATION_SECONDS, SPAWN_TOTAL
+
+def log_event(log, event, **fields):
+    """
+    Logs a structured event as a single line of JSON, so that it can be
+    picked out of the Hub's logs and aggregated.
+    """
+    fields["event"] = event
+    fields["time"] = round(time.time(), 3)
+    log.info("event: %s", json.dumps(fields, sort_keys=True))
+
+class SpawnTimeline:
+    """
+    Records how long each stage of a user's spawn takes. Stages are
+    contiguous: each one starts when the previous one ended, and the first
+    starts when the timeline is created. Every stage is observed in
+    SPAWN_STAGE_DURATION_SECONDS, and logged as an event keyed by the username
+    and a per-spawn ID.
+    """
+
+    def __init__(self, log, username):
+        self.log = log
+        self.username = username
+        self.spawn_id = uuid.uuid4().hex
+        self.stages = []
+        # The last stage marked, if any
+        self.last_stage = None
+        # The stage in progress when the spawn failed, if whoever failed it
+        # knows
+        self.failed_stage = None
+        self.started_at = self._last_mark = time.monotonic()
+
+    def mark(self, stage):
+        """Ends `stage`, a `metrics.SpawnStage`."""
+        now = time.monotonic()
+        duration = now - self._last_mark
+        self._last_mark = now
+        self.last_stage = stage
+        self.stages.append((str(stage), duration))
+        SPAWN_STAGE_DURATION_SECONDS.labels(stage=stage).observe(duration)
+        self.log_event("spawn-stage", stage=str(stage), seconds=round(duration, 3))
+
+    def finish(self, outcome, stage=None):
+        """
+        Ends the spawn with the given `outcome`, a `metrics.SpawnOutcome`. For
+        failed spawns, `stage` is the stage that was in progress.
+        """
+        fields = {
+            "outcome": str(outcome),
+            "seconds": round(time.monotonic() - self.started_at, 3),
+            "stages": {name: round(duration, 3) for (name, duration) in self.stages},
+        }
+        if stage is not None:
+            fields["failed_stage"] = str(stage)
+        SPAWN_TOTAL.labels(outcome=outcome).inc()
+        self.log_event("spawn-finished", **fields)
+
+    def log_event(self, event, **fields):
+        log_event(self.log, event, user=self.username, spawn_id=self.spawn_id, **fields)
@@ -0,0 +1,358 @@
+"""
+A warm pool of idle user pods
+
+Cold spawns wait for a pod to be scheduled, for its image to be pulled, and
+for its containers to start. With a warm pool, a number of user pods are kept
+running ahead of time, waiting to be claimed. `PachydermAuthenticator` claims
+one in `pre_spawn_start`, and pushes the user's environment (including their
+Pachyderm token), config files and notebook server command into it as a
+script. `WarmPoolSpawner` then adopts the claimed pod as the user's, rather
+than creating a new one.
+
+Pool pods are only interchangeable if nothing in their spec depends on the
+user, so spawns that mount per-user volumes or use lifecycle hooks always
+start a new pod.
+"""
+import re
+import copy
+import json
+import time
+import base64
+import shlex
+import hashlib
+import functools
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.stream import stream
+from kubernetes.stream.ws_client import ERROR_CHANNEL
+from kubespawner import KubeSpawner
+from kubespawner.clients import shared_client
+from jupyterhub.utils import exponential_backoff
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from .metrics import WARM_POOL_IDLE_PODS
+
+# Pool pods are labelled "idle" until they're claimed. Once adopted by a
+# spawner, they're labelled like any other user pod.
+POOL_LABEL = "pachyderm.io/warm-pool"
+POOL_COMPONENT = "singleuser-warm"
+POD_NAME_PREFIX = "jupyter-warm-"
+
+# Pool pods are labelled with a hash of the spec they were created from, and
+# spawns only claim pods whose spec matches their own
+TEMPLATE_LABEL = "pachyderm.io/warm-pool-template"
+
+# When a pod was claimed, so that pods claimed by a Hub that went away before
+# adopting them can be cleaned up
+CLAIMED_AT_ANNOTATION = "pachyderm.io/warm-pool-claimed-at"
+
+# Seconds after which a claimed pod that hasn't been adopted is deleted
+CLAIM_EXPIRY = 600
+
+# Claims are pushed into pool pods as a shell script, written to a volume that
+# only pool pods have. Their notebook containers wait for it, and run it.
+CLAIM_VOLUME = "warm-pool-claim"
+CLAIM_DIR = "/var/run/warm-pool"
+CLAIM_SCRIPT = CLAIM_DIR + "/claim.sh"
+WAIT_FOR_CLAIM = "until [ -f {0} ]; do sleep 0.1; done; . {0}".format(CLAIM_SCRIPT)
+
+# Seconds to wait for a claim script to be written into a pod
+PUSH_TIMEOUT = 10
+
+ANNOTATION_FIELD_PATH_PARSER = re.compile(r"^metadata\.annotations\['(.+)'\]$")
+
+def is_pod_ready(pod):
+    """Returns whether a pool pod is running, and waiting to be claimed"""
+    return (
+        pod.metadata.deletion_timestamp is None and
+        pod.status.phase == "Running" and
+        all(cs.ready for cs in pod.status.container_statuses or [])
+    )
+
+class WarmPoolSpawner(KubeSpawner):
+    """
+    A KubeSpawner that adopts a pod from the warm pool, if the authenticator
+    claimed one for the spawn, rather than creating a new pod.
+    """
+
+    # The pool pod claimed for the next start, if any. This is set by the
+    # authenticator's `pre_spawn_start`.
+    warm_pod_name = None
+
+    @gen.coroutine
+    def get_warm_pod_template(self):
+        """
+        Returns a tuple of (template hash, pool pod manifest, claim script)
+        for this spawn, or `None` if its pod can't come from the pool. The
+        manifest is a dict that doesn't depend on the user. The claim script
+        turns a pool pod created from it into this user's pod.
+        """
+        if self.lifecycle_hooks or not self.cmd:
+            return None
+
+        pod = client.ApiClient().sanitize_for_serialization((yield self.get_pod_manifest()))
+        spec = pod["spec"]
+        volumes = spec.get("volumes", [])
+        container = next(c for c in spec["containers"] if c["name"] == "notebook")
+        mounts = {m["name"]: m for m in container.get("volumeMounts", [])}
+        env = container.pop("env", [])
+
+        if any("persistentVolumeClaim" in v for v in volumes) or any("valueFrom" in e for e in env):
+            return None
+
+        # Files in downward API volumes come from the pod's annotations, which
+        # are per-user. Pool pods get writable, empty volumes in their place,
+        # and the claim script fills them in.
+        annotations = pod["metadata"].get("annotations", {})
+        files = {}
+        for volume in volumes:
+            if "downwardAPI" not in volume:
+                continue
+            mount = mounts.get(volume["name"])
+            for item in volume.pop("downwardAPI")["items"]:
+                match = ANNOTATION_FIELD_PATH_PARSER.match(item.get("fieldRef", {}).get("fieldPath", ""))
+                if mount is None or match is None or match.group(1) not in annotations:
+                    return None
+                files["{}/{}".format(mount["mountPath"].rstrip("/"), item["path"])] = annotations[match.group(1)]
+            volume["emptyDir"] = {}
+            if mount is not None:
+                mount.pop("readOnly", None)
+
+        lines = ["printf '%s' {} > {}".format(shlex.quote(content), shlex.quote(path)) for (path, content) in sorted(files.items())]
+        if container.get("workingDir"):
+            lines.append("cd {}".format(shlex.quote(container["workingDir"])))
+        lines.append("exec env {} {}".format(
+            " ".join(shlex.quote("{}={}".format(e["name"], e.get("value") or "")) for e in env),
+            " ".join(shlex.quote(arg) for arg in container["args"]),
+        ))
+        script = "\n".join(lines) + "\n"
+
+        container["args"] = ["sh", "-c", WAIT_FOR_CLAIM]
+        container.setdefault("volumeMounts", []).append({"name": CLAIM_VOLUME, "mountPath": CLAIM_DIR})
+        spec["volumes"] = volumes + [{"name": CLAIM_VOLUME, "emptyDir": {}}]
+
+        template_hash = hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf8")).hexdigest()[:16]
+        labels = dict(self.common_labels)
+        labels.update({
+            "component": POOL_COMPONENT,
+            POOL_LABEL: "idle",
+            TEMPLATE_LABEL: template_hash,
+        })
+        pod["metadata"] = {
+            "generateName": POD_NAME_PREFIX,
+            "labels": labels,
+        }
+        return (template_hash, pod, script)
+
+    @gen.coroutine
+    def _start(self):
+        # A previous spawn may have adopted a pool pod, which has a different
+        # name
+        self.pod_name = self._expand_user_properties(self.pod_name_template)
+
+        name, self.warm_pod_name = self.warm_pod_name, None
+        if name is not None:
+            try:
+                result = yield self.adopt_warm_pod(name)
+                return result
+            except Exception:
+                self.log.exception("could not adopt warm pool pod %s; starting a new pod instead", name)
+                self.pod_name = self._expand_user_properties(self.pod_name_template)
+                try:
+                    yield self.asynchronize(self.api.delete_namespaced_pod, name=name, namespace=self.namespace, body=client.V1DeleteOptions())
+                except ApiException as e:
+                    if e.status != 404:
+                        self.log.warning("could not delete warm pool pod %s: %s", name, e)
+
+        result = yield super()._start()
+        return result
+
+    @gen.coroutine
+    def adopt_warm_pod(self, name):
+        """
+        Makes a claimed pool pod this user's, by labelling and annotating it
+        like a new user pod would be, and waits for it to show up as running.
+        """
+        pod = yield self.get_pod_manifest()
+        yield self.asynchronize(self.api.patch_namespaced_pod, name, self.namespace, {
+            "metadata": {
+                "labels": pod.metadata.labels,
+                "annotations": pod.metadata.annotations,
+            },
+        })
+        self.pod_name = name
+
+        yield exponential_backoff(
+            lambda: self.is_pod_running(self.pod_reflector.pods.get(name, None)),
+            "pod/{} did not show up as running in {} seconds!".format(name, self.start_timeout),
+            timeout=self.start_timeout,
+        )
+        pod = self.pod_reflector.pods[name]
+        self.pod_id = pod.metadata.uid
+        self.log.info("adopted warm pool pod %s for %s", name, self.user.name)
+        return (pod.status.pod_ip, self.port)
+
+class WarmPool:
+    """
+    Keeps `size` idle pool pods running, and hands them out to spawns.
+
+    Pool pods are created from the template of the latest spawn that could
+    use one (see `WarmPoolSpawner.get_warm_pod_template`), so the pool is
+    only filled once such a spawn has happened. Idle pods left over from a
+    previous Hub can be claimed before then.
+    """
+
+    def __init__(self, log, size):
+        self.log = log
+        self.size = size
+        self.api = shared_client("CoreV1Api")
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.namespace = None
+        self.template_hash = None
+        self.manifest = None
+        self._refilling = False
+
+    def run_blocking(self, f, *args, **kwargs):
+        """Runs a blocking kubernetes API call on the pool's thread pool"""
+        return IOLoop.current().run_in_executor(self.executor, functools.partial(f, *args, **kwargs))
+
+    def set_template(self, namespace, template_hash, manifest):
+        """Sets the template that new pool pods are created from"""
+        self.namespace = namespace
+        self.template_hash = template_hash
+        self.manifest = manifest
+
+    @gen.coroutine
+    def list_pods(self):
+        """Returns pool pods that haven't been adopted by a spawner yet"""
+        pods = yield self.run_blocking(
+            self.api.list_namespaced_pod,
+            self.namespace,
+            label_selector="component={},{}".format(POOL_COMPONENT, POOL_LABEL),
+        )
+        return [p for p in pods.items if p.metadata.deletion_timestamp is None]
+
+    @gen.coroutine
+    def delete_pod(self, name):
+        try:
+            yield self.run_blocking(self.api.delete_namespaced_pod, name, self.namespace, client.V1DeleteOptions(), grace_period_seconds=0)
+        except ApiException as e:
+            if e.status != 404:
+                self.log.warning("could not delete warm pool pod %s: %s", name, e)
+
+    @gen.coroutine
+    def claim(self, script):
+        """
+        Claims a ready, idle pod created from the current template, and
+        pushes `script` into it. Returns the pod's name, or `None` if there
+        wasn't one.
+        """
+        pods = yield self.list_pods()
+        for pod in pods:
+            labels = pod.metadata.labels
+            if labels.get(POOL_LABEL) != "idle" or labels.get(TEMPLATE_LABEL) != self.template_hash or not is_pod_ready(pod):
+                continue
+
+            name = pod.metadata.name
+            try:
+                # Setting the resource version makes this fail if the pod was
+                # claimed after it was listed
+                yield self.run_blocking(self.api.patch_namespaced_pod, name, self.namespace, {
+                    "metadata": {
+                        "resourceVersion": pod.metadata.resource_version,
+                        "labels": {POOL_LABEL: "claimed"},
+                        "annotations": {CLAIMED_AT_ANNOTATION: str(int(time.time()))},
+                    },
+                })
+            except ApiException as e:
+                if e.status in (404, 409):
+                    continue
+                raise
+
+            try:
+                yield self.run_blocking(self.push_claim_script, name, script)
+            except Exception:
+                yield self.delete_pod(name)
+                raise
+            return name
+        return None
+
+    def push_claim_script(self, name, script):
+        """Writes a claim script into a pool pod. This blocks."""
+        data = base64.b64encode(script.encode("utf8")).decode("ascii")
+        # The exec API can't close stdin, so the script's length is passed
+        # along instead. It's written to a temporary file first, so that the
+        # pod never runs a partial script.
+        command = "head -c {0} | base64 -d > {1}.tmp && mv {1}.tmp {1}".format(len(data), CLAIM_SCRIPT)
+        resp = stream(
+            self.api.connect_get_namespaced_pod_exec,
+            name,
+            self.namespace,
+            container="notebook",
+            command=["sh", "-c", command],
+            stdin=True,
+            stdout=True,
+            stderr=True,
+            tty=False,
+            _preload_content=False,
+        )
+        try:
+            resp.write_stdin(data)
+            deadline = time.monotonic() + PUSH_TIMEOUT
+            while resp.is_open():
+                if time.monotonic() > deadline:
+                    raise TimeoutError("timed out pushing a claim script to pod {}".format(name))
+                resp.update(timeout=1)
+            status = json.loads(resp.read_channel(ERROR_CHANNEL) or "{}")
+            if status.get("status") != "Success":
+                raise Exception("could not push a claim script to pod {}: {}".format(name, status.get("message") or resp.read_stderr()))
+        finally:
+            resp.close()
+
+    @gen.coroutine
+    def refill(self):
+        """
+        Tops up the pool to `size` idle pods, and deletes pool pods that can't
+        be claimed: those created from an outdated template, those that have
+        exited, and those that were claimed but never adopted.
+        """
+        if self.manifest is None or self._refilling:
+            return
+
+        self._refilling = True
+        try:
+            pods = yield self.list_pods()
+            now = time.time()
+            idle = []
+            unusable = []
+            for pod in pods:
+                if pod.metadata.labels.get(POOL_LABEL) == "claimed":
+                    claimed_at = int((pod.metadata.annotations or {}).get(CLAIMED_AT_ANNOTATION, 0))
+                    if now - claimed_at > CLAIM_EXPIRY:
+                        unusable.append(pod)
+                elif pod.metadata.labels.get(TEMPLATE_LABEL) != self.template_hash or pod.status.phase in ("Succeeded", "Failed"):
+                    unusable.append(pod)
+                else:
+                    idle.append(pod)
+
+            # Keep the pods that are furthest along
+            idle.sort(key=lambda p: (not is_pod_ready(p), p.metadata.creation_timestamp or datetime.now(timezone.utc)))
+            unusable.extend(idle[self.size:])
+            idle = idle[:self.size]
+
+            yield [self.delete_pod(pod.metadata.name) for pod in unusable]
+            missing = self.size - len(idle)
+            yield [self.run_blocking(self.api.create_namespaced_pod, self.namespace, copy.deepcopy(self.manifest)) for _ in range(missing)]
+
+            WARM_POOL_IDLE_PODS.set(sum(1 for pod in idle if is_pod_ready(pod)))
+            if unusable or missing:
+                self.log.info("refilled the warm pool: created %d pods, and deleted %d", missing, len(unusable))
+        except Exception:
+            self.log.exception("could not refill the warm pool")
+        finally:
+            self._refilling = False
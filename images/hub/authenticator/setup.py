@@ -7,5 +7,7 @@ setup(
     packages=['pachyderm_authenticator'],
     install_requires=[
         'python-pachyderm>=4.0.0',
+        'grpcio',
+        'prometheus_client',
     ],
 )
\ No newline at end of file
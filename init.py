@@ -4,67 +4,205 @@ import os
 import re
 import sys
 import json
+import time
+import hashlib
+import shutil
 import secrets
 import argparse
 import tempfile
 import traceback
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 KUBE_CONTEXT_INFO_PARSER = re.compile(r"^\* +[^ ]* +([^ ]*) +([^ ]*) +([^ \n]*)\n", re.MULTILINE)
 AUTH_TOKEN_PARSER = re.compile(r"  Token: ([0-9a-f]+)", re.MULTILINE)
 WHO_AM_I_PARSER = re.compile(r"You are \"(.+)\"")
 
-BASE_CONFIG = """
-hub:
-  image:
-    name: pachyderm/jupyterhub-pachyderm-hub
-    tag: "{version}"
-singleuser:
-  image:
-    name: pachyderm/jupyterhub-pachyderm-user
-    tag: "{version}"
-"""
-
-AUTH_BASE_CONFIG = """
-auth:
-  state:
-    enabled: true
-    cryptoKey: "{auth_state_crypto_key}"
-  type: custom
-  custom:
-    className: pachyderm_authenticator.PachydermAuthenticator
-    config:
-      pach_auth_token: "{pach_auth_token}"
-"""
-
-AUTH_ADMIN_CONFIG = """
-  admin:
-    users:
-      - "{admin_user}"
-"""
-
-PROXY_BASE_CONFIG = """
-proxy:
-  secretToken: "{secret_token}"
-"""
-
-PROXY_TLS_CONFIG = """
-  https:
-    hosts:
-      - "{tls_host}"
-    letsencrypt:
-      contactEmail: "{tls_email}"
-"""
+HELM_REPO_URL = "https://jupyterhub.github.io/helm-chart/"
+RELEASE_NAME = "jhub"
+
+# Selects the pods and deployments that make JupyterHub usable. User pods
+# aren't included, since there aren't any right after a deploy.
+ROLLOUT_SELECTOR = "app=jupyterhub,release={},component in (hub,proxy)".format(RELEASE_NAME)
+ROLLOUT_COMPONENTS = ["hub", "proxy"]
+
+# Reasons a container can be waiting that won't resolve on their own
+POD_FAILURE_REASONS = ["CrashLoopBackOff", "ErrImagePull", "ImagePullBackOff", "InvalidImageName", "CreateContainerConfigError"]
+
+# Annotation on deployments and their ReplicaSets with the revision they're
+# at, which identifies a deployment's current ReplicaSet
+REVISION_ANNOTATION = "deployment.kubernetes.io/revision"
+
+# Kinds of resources that make up a JupyterHub installation, all labelled
+# with TEARDOWN_SELECTOR. Most are part of the helm release, but user pods,
+# their storage and warm pool pods are created by the Hub.
+TEARDOWN_KINDS = ["deployments", "daemonsets", "statefulsets", "replicasets", "pods", "services", "persistentvolumeclaims", "configmaps", "secrets"]
+TEARDOWN_SELECTOR = "app=jupyterhub"
+
+# Seconds between checks for resources that haven't been removed yet
+TEARDOWN_POLL_INTERVAL = 1
+
+PACH_CONFIG_PATH = os.environ.get("PACH_CONFIG", os.path.expanduser("~/.pachyderm/config.json"))
+
+# Number of commands listed in the `--profile` summary
+PROFILE_SUMMARY_COMMANDS = 10
+
+HEX_SECRET_PARSER = re.compile(r"^[0-9a-f]{64}$")
+YAML_PLAIN_KEY_PARSER = re.compile(r"^[A-Za-z_][A-Za-z0-9_.-]*$")
+# Plain scalars that YAML 1.1, which helm uses, reads as booleans or null
+# rather than strings, so keys that match them have to be quoted
+YAML_RESERVED_SCALARS = {"y", "yes", "n", "no", "true", "false", "on", "off", "null"}
 
 class ApplicationError(Exception):
     pass
 
-def run(cmd, *args, capture_stdout=False, capture_stderr=False, raise_on_error=True):
-    proc = subprocess.run(
-        [cmd, *args],
-        stdout=subprocess.PIPE if capture_stdout else None,
-        stderr=subprocess.PIPE if capture_stderr else None,
+class Profiler:
+    """
+    Records how long each section and command takes, for `--profile`.
+    Events are kept in the Chrome trace event format, so that the output can
+    be loaded into chrome://tracing or Perfetto. Commands run from probe or
+    fleet threads are shown on their own tracks.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.started_at = time.time()
+        self.events = []
+        self.threads = {}
+        # the current section's name and start time
+        self.section = None
+        self._lock = threading.Lock()
+
+    def add(self, category, name, start, end, **args):
+        """Records an event that started and ended at the given monotonic times"""
+        with self._lock:
+            tid = self.threads.setdefault(threading.current_thread().name, len(self.threads) + 1)
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": round((start - self.start) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "args": args,
+            })
+
+    def start_section(self, name):
+        now = time.monotonic()
+        self.end_section(now)
+        self.section = (name, now)
+
+    def end_section(self, now=None):
+        if self.section is not None:
+            name, start = self.section
+            self.add("section", name, start, now or time.monotonic())
+            self.section = None
+
+    def write(self, path, exit_code):
+        self.end_section()
+        thread_names = [{
+            "name": "thread_name",
+            "ph": "M",
+            "pid": 1,
+            "tid": tid,
+            "args": {"name": name},
+        } for (name, tid) in self.threads.items()]
+        with open(path, "w") as f:
+            json.dump({
+                "traceEvents": thread_names + self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {
+                    "argv": sys.argv,
+                    "started_at": self.started_at,
+                    "seconds": time.monotonic() - self.start,
+                    "exit_code": exit_code,
+                },
+            }, f, indent=2)
+
+    def print_summary(self):
+        self.end_section()
+        sections = [e for e in self.events if e["cat"] == "section"]
+        commands = sorted((e for e in self.events if e["cat"] == "command"), key=lambda e: e["dur"], reverse=True)
+        print("{:>8}  {}".format("duration", "section"))
+        for e in sections:
+            print("{:>7.2f}s  {}".format(e["dur"] / 1e6, e["name"]))
+        print()
+        print("{:>8}  {:>4}  {:>8}  {}".format("duration", "exit", "output", "command (slowest first)"))
+        for e in commands[:PROFILE_SUMMARY_COMMANDS]:
+            print("{:>7.2f}s  {:>4}  {:>7}B  {}".format(
+                e["dur"] / 1e6,
+                e["args"]["exit_code"],
+                e["args"]["stdout_bytes"] + e["args"]["stderr_bytes"],
+                e["name"],
+            ))
+
+# Set by `--profile`
+PROFILER = None
+
+def command_name(argv):
+    """Returns a short name for a command, e.g. `helm upgrade`"""
+    words = []
+    for arg in argv[:3]:
+        if arg.startswith("-"):
+            break
+        words.append(arg)
+    return " ".join(words)
+
+def pump_lines(pipe, out, capture, results, key):
+    """
+    Reads `pipe` line by line until it closes, capturing the lines or
+    writing them to `out` as they arrive. Stores a tuple of (captured bytes or
+    `None`, number of bytes read) in `results[key]`.
+    """
+    captured = []
+    size = 0
+    for line in pipe:
+        size += len(line)
+        if capture:
+            captured.append(line)
+        else:
+            out.write(line.decode("utf8", errors="replace"))
+            out.flush()
+    results[key] = (b"".join(captured) if capture else None, size)
+
+def run_profiled(argv, capture_stdout, capture_stderr):
+    """
+    Runs a command like `subprocess.run`, recording it on `PROFILER`. Output
+    that isn't captured is passed through line by line rather than
+    inherited, so that its size can be recorded too.
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    results = {}
+    stderr_pump = threading.Thread(target=pump_lines, args=(proc.stderr, sys.stderr, capture_stderr, results, "stderr"))
+    stderr_pump.start()
+    pump_lines(proc.stdout, sys.stdout, capture_stdout, results, "stdout")
+    stderr_pump.join()
+    returncode = proc.wait()
+
+    PROFILER.add(
+        "command",
+        command_name(argv),
+        start,
+        time.monotonic(),
+        argv=argv,
+        exit_code=returncode,
+        stdout_bytes=results["stdout"][1],
+        stderr_bytes=results["stderr"][1],
     )
+    return subprocess.CompletedProcess(argv, returncode, results["stdout"][0], results["stderr"][0])
+
+def run(cmd, *args, capture_stdout=False, capture_stderr=False, raise_on_error=True):
+    if PROFILER is not None:
+        proc = run_profiled([cmd, *args], capture_stdout, capture_stderr)
+    else:
+        proc = subprocess.run(
+            [cmd, *args],
+            stdout=subprocess.PIPE if capture_stdout else None,
+            stderr=subprocess.PIPE if capture_stderr else None,
+        )
 
     stdout = proc.stdout.decode("utf8") if proc.stdout else None
     stderr = proc.stderr.decode("utf8") if proc.stderr else None
@@ -98,7 +236,7 @@ def run_auth_command(*args):
 
 def run_version_check(cmd, *args):
     try:
-        run(cmd, *args)
+        return run(cmd, *args, capture_stdout=True)
     except subprocess.CalledProcessError as e:
         raise ApplicationError("could not check {} version; ensure {} is installed".format(cmd, cmd)) from e
 
@@ -110,94 +248,382 @@ def run_helm(debug, *args, **kwargs):
     
 
 def print_section(section):
+    if PROFILER is not None:
+        PROFILER.start_section(section)
     print("===> {}".format(section))
 
-def main(debug, no_verify_contexts, dry_run, tls_host, tls_email, jupyterhub_version, version):
-    # print versions, which in the process validates that dependencies are installed
-    print_section("checking dependencies are installed")
-    run_version_check("kubectl", "version")
-    run_version_check("pachctl", "version")
-    run_version_check("helm", "version")
+def run_probes(debug, probes):
+    """
+    Runs `probes`, a list of (name, function, names of dependencies), on a
+    thread pool. Each probe starts once the probes it depends on have
+    finished, and is skipped if any of them failed; its function is called
+    with their return values. Returns a dict of probe names to the values
+    their functions returned.
 
-    print_section("configuring helm")
-    run_helm(debug, "repo", "add", "jupyterhub", "https://jupyterhub.github.io/helm-chart/")
-    run_helm(debug, "repo", "update")
+    If any probes fail, the error of the first one in `probes` is raised,
+    so errors are reported in the same order as if the probes had run one
+    after another.
+    """
+    futures = {}
+    timings = {}
 
-    if not no_verify_contexts:
-        # parse pach context
-        print_section("getting pachyderm context")
+    def run_probe(name, f, dependencies):
+        args = [futures[dependency].result() for dependency in dependencies]
+        start = time.monotonic()
         try:
-            pach_context_name = run("pachctl", "config", "get", "active-context", capture_stdout=True).strip()
-            pach_context_output = run("pachctl", "config", "get", "context", pach_context_name, capture_stdout=True)
-            pach_context_json = json.loads(pach_context_output)
-            pach_cluster = pach_context_json.get("cluster_name", "")
-            pach_auth_info = pach_context_json.get("auth_info", "")
-            pach_namespace = pach_context_json.get("namespace", "default")
-        except Exception as e:
-            raise ApplicationError("could not parse pach context info") from e
-        if debug:
-            print("pach cluster: {}".format(pach_cluster))
-            print("pach auth info: {}".format(pach_auth_info))
-            print("pach namespace: {}".format(pach_namespace))
+            return f(*args)
+        finally:
+            timings[name] = time.monotonic() - start
+            if PROFILER is not None:
+                PROFILER.add("probe", name, start, start + timings[name])
 
-        # parse kubectl context
-        print_section("getting kubernetes context")
-        try:
-            kube_context_name = run("kubectl", "config", "current-context", capture_stdout=True).strip()
-            kube_context_output = run("kubectl", "config", "get-contexts", kube_context_name, capture_stdout=True)
-            kube_cluster, kube_auth_info, kube_namespace = KUBE_CONTEXT_INFO_PARSER.search(kube_context_output).groups()
-            kube_namespace = kube_namespace or "default"
-        except Exception as e:
-            raise ApplicationError("could not parse kube context info") from e
+    start = time.monotonic()
+    # one worker per probe, so that probes waiting on their dependencies
+    # can't starve the probes they're waiting on
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        for (name, f, dependencies) in probes:
+            futures[name] = executor.submit(run_probe, name, f, dependencies)
+    elapsed = time.monotonic() - start
+
+    if debug:
+        for (name, _, _) in probes:
+            if name in timings:
+                print("{}: {:.2f}s".format(name, timings[name]))
+            else:
+                print("{}: skipped".format(name))
+        print("total: {:.2f}s (vs. {:.2f}s sequentially)".format(elapsed, sum(timings.values())))
+
+    return {name: futures[name].result() for (name, _, _) in probes}
+
+def configure_helm(debug, jupyterhub_version):
+    # `helm search repo` only looks at the locally cached index, so if the
+    # pinned chart is already there, there's no need to fetch the index again
+    stdout, _ = run("helm", "search", "repo", "jupyterhub/jupyterhub", "--version", jupyterhub_version, "-o", "json", capture_stdout=True, capture_stderr=True, raise_on_error=False)
+    try:
+        cached = bool(json.loads(stdout))
+    except (TypeError, ValueError):
+        cached = False
+    if cached:
         if debug:
-            print("kube cluster: {}".format(kube_cluster))
-            print("kube auth info: {}".format(kube_auth_info))
-            print("kube namespace: {}".format(kube_namespace))
-
-        # verify that the contexts are pointing to the same thing
-        print_section("comparing pachyderm/kubernetes contexts")
-        if pach_cluster != kube_cluster:
-            raise ApplicationError("the active pach context's cluster name ('{}') is not the same as the current kubernetes context's cluster name ('{}')".format(pach_cluster, kube_cluster))
-        if pach_auth_info != kube_auth_info:
-            raise ApplicationError("the active pach context's auth info ('{}') is not the same as the current kubernetes context's auth info ('{}')".format(pach_auth_info, kube_auth_info))
-        if pach_namespace != kube_namespace:
-            raise ApplicationError("the active pach context's namespace ('{}') is not the same as the current kubernetes context's namespace ('{}')".format(pach_namespace, kube_namespace))
-
-    # verify enterprise is enabled
-    print_section("checking enterprise")
+            print("jupyterhub chart {} is already in the cached helm index; skipping repo update".format(jupyterhub_version))
+        return
+
+    run_helm(debug, "repo", "add", "jupyterhub", HELM_REPO_URL, capture_stdout=True)
+    run_helm(debug, "repo", "update", capture_stdout=True)
+
+def get_release():
+    """
+    Returns a dict with the user-supplied values of the existing JupyterHub
+    release, and whether it's deployed. Returns `None` if there's no release.
+    """
+    stdout, stderr = run("helm", "status", RELEASE_NAME, "-o", "json", capture_stdout=True, capture_stderr=True, raise_on_error=False)
+    if not stdout:
+        if "not found" in stderr:
+            return None
+        print(stderr, file=sys.stderr)
+        raise ApplicationError("could not get the status of the existing jupyterhub release")
+
+    try:
+        status = json.loads(stdout)["info"]["status"]
+        values = json.loads(run("helm", "get", "values", RELEASE_NAME, "-o", "json", capture_stdout=True)) or {}
+    except Exception as e:
+        raise ApplicationError("could not parse the existing jupyterhub release") from e
+
+    return {
+        "values": values,
+        "deployed": status == "deployed",
+    }
+
+def get_release_value(release, *path):
+    """
+    Returns the release value at `path`, or `None` if there's no release or
+    the value isn't set
+    """
+    value = release["values"] if release else None
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def get_pach_context():
+    try:
+        pach_context_name = run("pachctl", "config", "get", "active-context", capture_stdout=True).strip()
+        pach_context_output = run("pachctl", "config", "get", "context", pach_context_name, capture_stdout=True)
+        pach_context_json = json.loads(pach_context_output)
+        pach_cluster = pach_context_json.get("cluster_name", "")
+        pach_auth_info = pach_context_json.get("auth_info", "")
+        pach_namespace = pach_context_json.get("namespace", "default")
+    except Exception as e:
+        raise ApplicationError("could not parse pach context info") from e
+    return (pach_cluster, pach_auth_info, pach_namespace)
+
+def get_kube_context():
+    try:
+        kube_context_name = run("kubectl", "config", "current-context", capture_stdout=True).strip()
+        kube_context_output = run("kubectl", "config", "get-contexts", kube_context_name, capture_stdout=True)
+        kube_cluster, kube_auth_info, kube_namespace = KUBE_CONTEXT_INFO_PARSER.search(kube_context_output).groups()
+        kube_namespace = kube_namespace or "default"
+    except Exception as e:
+        raise ApplicationError("could not parse kube context info") from e
+    return (kube_cluster, kube_auth_info, kube_namespace)
+
+def compare_contexts(debug, pach_context, kube_context):
+    pach_cluster, pach_auth_info, pach_namespace = pach_context
+    kube_cluster, kube_auth_info, kube_namespace = kube_context
+
+    if debug:
+        print("pach cluster: {}".format(pach_cluster))
+        print("pach auth info: {}".format(pach_auth_info))
+        print("pach namespace: {}".format(pach_namespace))
+        print("kube cluster: {}".format(kube_cluster))
+        print("kube auth info: {}".format(kube_auth_info))
+        print("kube namespace: {}".format(kube_namespace))
+
+    # verify that the contexts are pointing to the same thing
+    if pach_cluster != kube_cluster:
+        raise ApplicationError("the active pach context's cluster name ('{}') is not the same as the current kubernetes context's cluster name ('{}')".format(pach_cluster, kube_cluster))
+    if pach_auth_info != kube_auth_info:
+        raise ApplicationError("the active pach context's auth info ('{}') is not the same as the current kubernetes context's auth info ('{}')".format(pach_auth_info, kube_auth_info))
+    if pach_namespace != kube_namespace:
+        raise ApplicationError("the active pach context's namespace ('{}') is not the same as the current kubernetes context's namespace ('{}')".format(pach_namespace, kube_namespace))
+
+def check_enterprise(_):
     enterprise_state_stdout = run("pachctl", "enterprise", "get-state", capture_stdout=True)
     if not enterprise_state_stdout.startswith("Pachyderm Enterprise token state: ACTIVE"):
         raise ApplicationError("pachyderm enterprise doesn't seem to be enabled yet")
 
-    # check auth
-    print_section("checking auth")
+def get_admin_user(_):
     admin_user_stdout = run_auth_command("whoami")
     if not admin_user_stdout:
         raise ApplicationError("you must be logged into pachyderm to deploy JupyterHub")
-    admin_user = WHO_AM_I_PARSER.match(admin_user_stdout).groups()[0]
+    return WHO_AM_I_PARSER.match(admin_user_stdout).groups()[0]
+
+def get_pach_auth_token(release, admin_user, rotate):
+    # reuse the existing release's token, since changing it restarts the Hub
+    pach_auth_token = get_release_value(release, "auth", "custom", "config", "pach_auth_token")
+    if pach_auth_token and admin_user and not rotate:
+        return pach_auth_token
 
-    # generate pach auth token
-    print_section("generating a pach auth token")    
     pach_auth_token_stdout = run_auth_command("get-auth-token")
-    pach_auth_token = AUTH_TOKEN_PARSER.search(pach_auth_token_stdout).groups()[0] if pach_auth_token_stdout else ""
+    return AUTH_TOKEN_PARSER.search(pach_auth_token_stdout).groups()[0] if pach_auth_token_stdout else ""
+
+def watch_json(timeout, *args):
+    """
+    Runs `kubectl` with `args`, yielding each JSON object it streams. Raises
+    an `ApplicationError` if kubectl exits, or `timeout` seconds pass,
+    before the caller stops iterating.
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(["kubectl", *args], stdout=subprocess.PIPE)
+    timed_out = threading.Event()
+    size = 0
+
+    def kill():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    decoder = json.JSONDecoder()
+    buffer = ""
+
+    try:
+        for line in proc.stdout:
+            size += len(line)
+            buffer += line.decode("utf8")
+            # kubectl pretty-prints each object, so one can only be complete
+            # at a top-level closing brace
+            if line.startswith(b"}"):
+                obj, _ = decoder.raw_decode(buffer.strip())
+                buffer = ""
+                yield obj
+    finally:
+        timer.cancel()
+        proc.kill()
+        proc.wait()
+        if PROFILER is not None:
+            argv = ["kubectl", *args]
+            PROFILER.add("command", command_name(argv), start, time.monotonic(), argv=argv, exit_code=proc.returncode, stdout_bytes=size, stderr_bytes=0)
+
+    if timed_out.is_set():
+        raise ApplicationError("timed out after {}s".format(timeout))
+    raise ApplicationError("kubectl exited unexpectedly while watching")
+
+def is_pod_ready(pod):
+    conditions = pod.get("status", {}).get("conditions", [])
+    return any(c["type"] == "Ready" and c["status"] == "True" for c in conditions)
+
+def pod_failure(pod):
+    """
+    Returns why a pod is stuck in a way that won't fix itself, or `None`
+    if it isn't
+    """
+    status = pod.get("status", {})
+    for container in status.get("initContainerStatuses", []) + status.get("containerStatuses", []):
+        waiting = container.get("state", {}).get("waiting") or {}
+        if waiting.get("reason") in POD_FAILURE_REASONS:
+            return "container {} is in {}: {}".format(container["name"], waiting["reason"], waiting.get("message", "no details"))
+    return None
+
+def current_pod_template_hashes():
+    """
+    Returns the `pod-template-hash` labels of the pods from the current
+    revision of the hub and proxy deployments. Deployments whose controller
+    hasn't caught up with their latest spec are left out, since their
+    current ReplicaSet may not exist yet.
+    """
+    items = json.loads(run("kubectl", "get", "deployments,replicasets", "-l", ROLLOUT_SELECTOR, "-o", "json", capture_stdout=True))["items"]
+
+    revisions = set()
+    for deployment in items:
+        if deployment["kind"] != "Deployment":
+            continue
+        if deployment.get("status", {}).get("observedGeneration", 0) < deployment["metadata"]["generation"]:
+            continue
+        revisions.add((deployment["metadata"]["name"], deployment["metadata"].get("annotations", {}).get(REVISION_ANNOTATION)))
+
+    hashes = set()
+    for replica_set in items:
+        if replica_set["kind"] != "ReplicaSet":
+            continue
+        metadata = replica_set["metadata"]
+        for owner in metadata.get("ownerReferences", []):
+            if owner["kind"] == "Deployment" and (owner["name"], metadata.get("annotations", {}).get(REVISION_ANNOTATION)) in revisions:
+                hashes.add(metadata["labels"].get("pod-template-hash"))
+    return hashes
+
+def is_rolled_out():
+    """
+    Returns whether the deployments have finished rolling out. Pods
+    alone can't tell, since right after an upgrade the old pods may still
+    be the only ones.
+    """
+    deployments = json.loads(run("kubectl", "get", "deployments", "-l", ROLLOUT_SELECTOR, "-o", "json", capture_stdout=True))["items"]
+    for deployment in deployments:
+        replicas = deployment["spec"].get("replicas", 1)
+        status = deployment.get("status", {})
+        if status.get("observedGeneration", 0) < deployment["metadata"]["generation"]:
+            return False
+        if status.get("updatedReplicas", 0) != replicas or status.get("replicas", 0) != replicas:
+            return False
+    return True
+
+def wait_for_rollout(timeout):
+    """
+    Waits until the hub and proxy pods are ready, through a single watch,
+    printing how long each pod took. Raises an `ApplicationError` as soon as
+    a pod from the current revision is stuck, e.g. crash looping or failing
+    to pull its image. Stuck pods from previous revisions are ignored, since
+    the rollout replaces them.
+    """
+    start = time.monotonic()
+    pods = {}
+    ready = set()
+    # pod template hashes of the current revisions, looked up when a pod is
+    # stuck
+    current_hashes = set()
+
+    try:
+        for event in watch_json(timeout, "get", "pods", "-l", ROLLOUT_SELECTOR, "--watch", "--output-watch-events", "-o", "json"):
+            pod = event["object"]
+            name = pod["metadata"]["name"]
+            if event["type"] == "DELETED":
+                pods.pop(name, None)
+                continue
+            pods[name] = pod
+
+            failure = pod_failure(pod) if "deletionTimestamp" not in pod["metadata"] else None
+            if failure:
+                pod_hash = pod["metadata"]["labels"].get("pod-template-hash")
+                if pod_hash not in current_hashes:
+                    current_hashes = current_pod_template_hashes()
+                if pod_hash in current_hashes:
+                    raise ApplicationError("pod {} is failing: {}".format(name, failure))
+            if is_pod_ready(pod) and name not in ready:
+                ready.add(name)
+                print("{}: ready after {:.1f}s".format(name, time.monotonic() - start))
+
+            # terminating pods are from a previous rollout
+            if any("deletionTimestamp" in p["metadata"] for p in pods.values()):
+                continue
+            components = set(p["metadata"]["labels"].get("component") for p in pods.values())
+            if not all(c in components for c in ROLLOUT_COMPONENTS):
+                continue
+            if all(is_pod_ready(p) for p in pods.values()) and is_rolled_out():
+                return
+    except ApplicationError as e:
+        raise ApplicationError("jupyterhub did not become ready: {}".format(e)) from e
+
+def main(debug, no_verify_contexts, dry_run, tls_host, tls_email, jupyterhub_version, version, rotate_secrets, rotate_pach_auth_token, force_upgrade, overrides, wait_timeout):
+    # Independent checks run concurrently, since each is a CLI start plus,
+    # usually, a round trip to the cluster. Checking versions validates that
+    # dependencies are installed, so everything else depends on them.
+    probes = [
+        ("kubectl version", lambda: run_version_check("kubectl", "version"), []),
+        ("pachctl version", lambda: run_version_check("pachctl", "version"), []),
+        ("helm version", lambda: run_version_check("helm", "version"), []),
+        ("configure helm", lambda _: configure_helm(debug, jupyterhub_version), ["helm version"]),
+        ("existing release", lambda _: get_release(), ["helm version"]),
+    ]
+    # only generate a token once we know it'll be used, and on the right
+    # cluster
+    token_dependencies = ["existing release", "auth", "enterprise"]
+    if not no_verify_contexts:
+        probes += [
+            ("pachyderm context", lambda _: get_pach_context(), ["pachctl version"]),
+            ("kubernetes context", lambda _: get_kube_context(), ["kubectl version"]),
+            ("compare contexts", lambda pach_context, kube_context: compare_contexts(debug, pach_context, kube_context), ["pachyderm context", "kubernetes context"]),
+        ]
+        token_dependencies.append("compare contexts")
+    probes += [
+        ("enterprise", check_enterprise, ["pachctl version"]),
+        ("auth", get_admin_user, ["pachctl version"]),
+        ("pach auth token", lambda release, admin_user, *_: get_pach_auth_token(release, admin_user, rotate_secrets or rotate_pach_auth_token), token_dependencies),
+    ]
+
+    print_section("running preflight checks")
+    results = run_probes(debug, probes)
+
+    # print versions, which the preflight checks validated
+    print_section("checking dependencies are installed")
+    for name in ["kubectl version", "pachctl version", "helm version"]:
+        print(results[name], end="")
+
+    release = results["existing release"]
+    admin_user = results["auth"]
+    pach_auth_token = results["pach auth token"]
     assert (admin_user and pach_auth_token) or (not admin_user and not pach_auth_token)
 
     # generate the config
     print_section("generating config")
-    auth_state_crypto_key = secrets.token_hex(32)
-    secret_token = secrets.token_hex(32)
+    # reuse the existing release's secrets, since changing them restarts the
+    # Hub and proxy, and invalidates stored auth state
+    auth_state_crypto_key = get_release_value(release, "auth", "state", "cryptoKey")
+    secret_token = get_release_value(release, "proxy", "secretToken")
+    if rotate_secrets or not auth_state_crypto_key:
+        auth_state_crypto_key = secrets.token_hex(32)
+    if rotate_secrets or not secret_token:
+        secret_token = secrets.token_hex(32)
 
-    config = BASE_CONFIG.format(version=version)
+    values = render_values([
+        base_values(version),
+        auth_values(auth_state_crypto_key, pach_auth_token, admin_user),
+        proxy_values(secret_token, tls_host, tls_email),
+        *overrides,
+    ])
+    validate_values(values)
 
-    config += AUTH_BASE_CONFIG.format(
-        auth_state_crypto_key=auth_state_crypto_key,
-        pach_auth_token=pach_auth_token,
-    )
-    if admin_user:
-        config += AUTH_ADMIN_CONFIG.format(admin_user=admin_user)
-    config += PROXY_BASE_CONFIG.format(secret_token=secret_token)
-    if tls_host:
-        config += PROXY_TLS_CONFIG.format(tls_host=tls_host, tls_email=tls_email)
+    config = dump_values(values)
+    config_hash = hashlib.sha256("{}\n{}".format(jupyterhub_version, config).encode("utf8")).hexdigest()
+    # not used by the chart; records what was deployed, so that reruns with
+    # the same config can skip the upgrade
+    config += "\n" + dump_values({"jupyterhubPachyderm": {"configHash": config_hash}}) + "\n"
+
+    # dry runs always go through, so that they show what would be deployed
+    if not force_upgrade and not dry_run and release and release["deployed"] and get_release_value(release, "jupyterhubPachyderm", "configHash") == config_hash:
+        print_section("jupyterhub is already up to date; skipping upgrade")
+        return
 
     with tempfile.NamedTemporaryFile(delete=False) as f:
         f.write(config.encode("utf8"))
@@ -207,7 +633,7 @@ def main(debug, no_verify_contexts, dry_run, tls_host, tls_email, jupyterhub_ver
     # install JupyterHub
     print_section("installing jupyterhub")
     try:
-        args = [debug, "upgrade", "--install", "jhub", "jupyterhub/jupyterhub", "--version={}".format(jupyterhub_version), "--values", config_path]
+        args = [debug, "upgrade", "--install", RELEASE_NAME, "jupyterhub/jupyterhub", "--version={}".format(jupyterhub_version), "--values", config_path]
         if dry_run:
             args.append("--dry-run")
         run_helm(*args)
@@ -215,6 +641,429 @@ def main(debug, no_verify_contexts, dry_run, tls_host, tls_email, jupyterhub_ver
         if not debug:
             os.unlink(config_path)
 
+    if not dry_run and wait_timeout > 0:
+        print_section("waiting for jupyterhub to be ready")
+        wait_for_rollout(wait_timeout)
+
+def list_installation():
+    """
+    Returns the names of the resources that make up the JupyterHub
+    installation, keyed by their kind (e.g. `pod`), through a single call
+    """
+    items = json.loads(run("kubectl", "get", ",".join(TEARDOWN_KINDS), "-l", TEARDOWN_SELECTOR, "-o", "json", capture_stdout=True))["items"]
+    resources = {}
+    for item in items:
+        resources.setdefault(item["kind"].lower(), []).append(item["metadata"]["name"])
+    return resources
+
+def uninstall_release():
+    _, stderr = run("helm", "uninstall", RELEASE_NAME, capture_stdout=True, capture_stderr=True, raise_on_error=False)
+    # the release is optional, e.g. if a previous teardown got as far as
+    # uninstalling it
+    if stderr and "not found" not in stderr:
+        raise ApplicationError("could not uninstall helm release '{}': {}".format(RELEASE_NAME, stderr.strip()))
+
+def delete_kind(kind):
+    # doesn't wait, since resources are waited on all together afterwards
+    try:
+        _, stderr = run("kubectl", "delete", kind, "-l", TEARDOWN_SELECTOR, "--wait=false", "--ignore-not-found", capture_stdout=True, capture_stderr=True)
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr.decode("utf8") if e.stderr else ""
+        # e.g. the resources were deleted between listing and deleting them
+        if "NotFound" in stderr:
+            return
+        raise ApplicationError("could not delete {}: {}".format(kind, stderr.strip())) from e
+
+    # warnings don't mean the delete failed
+    if stderr:
+        print(stderr.strip(), file=sys.stderr)
+
+def main_teardown(dry_run, timeout):
+    """
+    Deletes the JupyterHub installation: the helm release, and everything
+    labelled as part of it, including user pods and their storage. Every
+    kind of resource is deleted concurrently, and then waited on until it's
+    gone, reporting how long each kind took.
+    """
+    print_section("finding jupyterhub resources")
+    resources = list_installation()
+    for (kind, names) in sorted(resources.items()):
+        print("{}: {}".format(kind, ", ".join(sorted(names))))
+    if dry_run:
+        return
+
+    print_section("deleting jupyterhub")
+    start = time.monotonic()
+    deletions = [("helm release", uninstall_release)] + [(kind, lambda kind=kind: delete_kind(kind)) for kind in sorted(resources)]
+    with ThreadPoolExecutor(max_workers=len(deletions)) as executor:
+        futures = [(name, executor.submit(f)) for (name, f) in deletions]
+    errors = []
+    for (name, future) in futures:
+        try:
+            future.result()
+        except ApplicationError as e:
+            errors.append(str(e))
+    if errors:
+        raise ApplicationError("; ".join(errors))
+    if timeout <= 0:
+        return
+
+    # kubectl can't watch several kinds at once, so everything is listed in
+    # one call, repeatedly. This also catches pods that controllers recreated
+    # before they were deleted themselves, which then get garbage collected.
+    print_section("waiting for jupyterhub to be removed")
+    remaining = resources
+    removed_after = {}
+    while True:
+        elapsed = time.monotonic() - start
+        for kind in resources:
+            if kind not in remaining and kind not in removed_after:
+                removed_after[kind] = elapsed
+                print("{}: removed {} after {:.1f}s".format(kind, len(resources[kind]), elapsed))
+        if not remaining:
+            break
+        if elapsed > timeout:
+            raise ApplicationError("timed out after {}s waiting for these to be removed: {}".format(
+                timeout,
+                ", ".join("{}/{}".format(kind, name) for (kind, names) in sorted(remaining.items()) for name in sorted(names)),
+            ))
+        time.sleep(TEARDOWN_POLL_INTERVAL)
+        remaining = list_installation()
+
+    print_section("jupyterhub was removed in {:.1f}s".format(time.monotonic() - start))
+
+def base_values(version):
+    return {
+        "hub": {
+            "image": {
+                "name": "pachyderm/jupyterhub-pachyderm-hub",
+                "tag": version,
+            },
+        },
+        "singleuser": {
+            "image": {
+                "name": "pachyderm/jupyterhub-pachyderm-user",
+                "tag": version,
+            },
+        },
+    }
+
+def auth_values(auth_state_crypto_key, pach_auth_token, admin_user):
+    values = {
+        "auth": {
+            "state": {
+                "enabled": True,
+                "cryptoKey": auth_state_crypto_key,
+            },
+            "type": "custom",
+            "custom": {
+                "className": "pachyderm_authenticator.PachydermAuthenticator",
+                "config": {
+                    "pach_auth_token": pach_auth_token,
+                },
+            },
+        },
+    }
+    if admin_user:
+        values["auth"]["admin"] = {"users": [admin_user]}
+    return values
+
+def proxy_values(secret_token, tls_host, tls_email):
+    values = {
+        "proxy": {
+            "secretToken": secret_token,
+        },
+    }
+    if tls_host:
+        values["proxy"]["https"] = {
+            "hosts": [tls_host],
+            "letsencrypt": {
+                "contactEmail": tls_email,
+            },
+        }
+    return values
+
+def deep_merge(base, override):
+    """
+    Returns a copy of `base` with `override` merged into it. Dicts are merged
+    recursively; anything else in `override`, including lists, replaces what's
+    in `base`.
+    """
+    merged = dict(base)
+    for (key, value) in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def render_values(layers):
+    """Merges `layers` of values, with later layers taking precedence"""
+    values = {}
+    for layer in layers:
+        values = deep_merge(values, layer)
+    return values
+
+def validate_values(values):
+    """
+    Checks the values that the chart or the authenticator would otherwise
+    fail on at deploy time, raising an `ApplicationError` listing every
+    problem found
+    """
+    def get(*path):
+        value = values
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    errors = []
+
+    # e.g. `on:` or `80:` in a YAML values file, which can't be passed on to
+    # helm as they are
+    def check_keys(value, path):
+        if isinstance(value, dict):
+            for (key, child) in value.items():
+                if not isinstance(key, str):
+                    errors.append("{} has a key that isn't a string: {!r}; quote it in the values file".format(path or "values", key))
+                    continue
+                check_keys(child, "{}.{}".format(path, key) if path else key)
+        elif isinstance(value, list):
+            for (i, child) in enumerate(value):
+                check_keys(child, "{}[{}]".format(path, i))
+    check_keys(values, "")
+
+    for component in ["hub", "singleuser"]:
+        for key in ["name", "tag"]:
+            value = get(component, "image", key)
+            if not isinstance(value, str) or not value:
+                hint = " (use --set-string for values that look like numbers)" if isinstance(value, (int, float)) and not isinstance(value, bool) else ""
+                errors.append("{}.image.{} must be a non-empty string{}".format(component, key, hint))
+
+    if get("auth", "state", "enabled") and not HEX_SECRET_PARSER.match(str(get("auth", "state", "cryptoKey"))):
+        errors.append("auth.state.cryptoKey must be 32 hex-encoded bytes")
+    if not isinstance(get("auth", "custom", "config", "pach_auth_token"), str):
+        errors.append("auth.custom.config.pach_auth_token must be a string")
+    admin_users = get("auth", "admin", "users")
+    if admin_users is not None and not (isinstance(admin_users, list) and all(isinstance(u, str) and u for u in admin_users)):
+        errors.append("auth.admin.users must be a list of usernames")
+
+    if not HEX_SECRET_PARSER.match(str(get("proxy", "secretToken"))):
+        errors.append("proxy.secretToken must be 32 hex-encoded bytes")
+    if get("proxy", "https", "hosts") and not get("proxy", "https", "letsencrypt", "contactEmail"):
+        errors.append("proxy.https.letsencrypt.contactEmail must be set when proxy.https.hosts is")
+
+    if errors:
+        raise ApplicationError("invalid helm values:\n{}".format("\n".join("  - {}".format(e) for e in errors)))
+
+def dump_values(values, indent=0):
+    """
+    Serializes values to YAML. Scalars and lists are written as JSON, which
+    is valid YAML, so the output is unambiguous without needing a YAML
+    library. The output is deterministic, for hashing. Keys must be strings,
+    which `validate_values` checks.
+    """
+    lines = []
+    for (key, value) in values.items():
+        if not YAML_PLAIN_KEY_PARSER.match(key) or key.lower() in YAML_RESERVED_SCALARS:
+            key = json.dumps(key)
+        if isinstance(value, dict) and value:
+            lines.append("{}{}:".format("  " * indent, key))
+            lines.append(dump_values(value, indent + 1))
+        else:
+            lines.append("{}{}: {}".format("  " * indent, key, json.dumps(value, sort_keys=True)))
+    return "\n".join(lines)
+
+def load_values_file(path):
+    """Loads user-supplied values from a YAML or JSON file"""
+    try:
+        with open(path, "r") as f:
+            if path.endswith(".json"):
+                values = json.load(f)
+            else:
+                try:
+                    import yaml
+                except ImportError:
+                    raise ApplicationError("PyYAML is required to read YAML values files; install it, or use a JSON file")
+                values = yaml.safe_load(f)
+    except (OSError, ValueError) as e:
+        raise ApplicationError("could not read values file '{}': {}".format(path, e)) from e
+
+    if values is None:
+        return {}
+    if not isinstance(values, dict):
+        raise ApplicationError("values file '{}' must contain a mapping".format(path))
+    return values
+
+def parse_set_value(setting, as_string=False):
+    """
+    Parses a `--set` value, like `hub.image.tag=1.2.3`, into values. The
+    value is parsed as JSON if possible, unless `as_string` is set, as it is
+    for `--set-string`.
+    """
+    flag = "--set-string" if as_string else "--set"
+    path, sep, value = setting.partition("=")
+    if not sep or not path:
+        raise ApplicationError("invalid {} value '{}'; expected KEY=VALUE".format(flag, setting))
+    if not as_string:
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    for key in reversed(path.split(".")):
+        value = {key: value}
+    return value
+
+def load_overrides(values_files, set_values, set_string_values):
+    """
+    Returns the layers of values that the user supplied, in order of
+    precedence: values files, then `--set` values, then `--set-string`
+    values
+    """
+    return (
+        [load_values_file(path) for path in values_files]
+        + [parse_set_value(setting) for setting in set_values]
+        + [parse_set_value(setting, as_string=True) for setting in set_string_values]
+    )
+
+def render_only(version, tls_host, tls_email, overrides):
+    """
+    Returns the helm values, without calling out to anything. Secrets are
+    freshly generated, and there's no pach auth token unless one is set
+    through the overrides.
+    """
+    values = render_values([
+        base_values(version),
+        auth_values(secrets.token_hex(32), "", None),
+        proxy_values(secrets.token_hex(32), tls_host, tls_email),
+        *overrides,
+    ])
+    validate_values(values)
+    return dump_values(values)
+
+def isolate_cluster(cluster_dir, kube_context, pach_context):
+    """
+    Writes kubernetes and pachyderm configs to `cluster_dir` that only point
+    to the given contexts, returning the environment variables that make
+    kubectl, helm and pachctl use them. This lets deployments to different
+    clusters run at the same time, without switching the active contexts.
+    """
+    kube_config_path = os.path.join(cluster_dir, "kubeconfig")
+    # errors are raised rather than printed, since this runs concurrently
+    # for every cluster
+    kube_config, stderr = run("kubectl", "config", "view", "--raw", "--flatten", "--minify", "--context", kube_context, capture_stdout=True, capture_stderr=True, raise_on_error=False)
+    if not kube_config:
+        raise ApplicationError("could not get kube context '{}': {}".format(kube_context, (stderr or "").strip()))
+    with open(kube_config_path, "w") as f:
+        f.write(kube_config)
+
+    pach_config_path = os.path.join(cluster_dir, "pach_config.json")
+    try:
+        with open(PACH_CONFIG_PATH, "r") as f:
+            pach_config = json.load(f)
+        if pach_context not in pach_config["v2"]["contexts"]:
+            raise ApplicationError("pach context '{}' does not exist".format(pach_context))
+        pach_config["v2"]["active_context"] = pach_context
+    except (OSError, ValueError, KeyError) as e:
+        raise ApplicationError("could not read pach config '{}'".format(PACH_CONFIG_PATH)) from e
+    with open(pach_config_path, "w") as f:
+        json.dump(pach_config, f)
+
+    return {
+        "KUBECONFIG": kube_config_path,
+        "PACH_CONFIG": pach_config_path,
+    }
+
+def deploy_cluster(index, kube_context, pach_context, log_dir, args):
+    """
+    Runs this script with `args` against the given contexts, logging to a
+    file in `log_dir`. Returns a dict describing how it went.
+    """
+    log_name = re.sub(r"[^A-Za-z0-9_.-]", "_", "{}-{}".format(index, kube_context))
+    log_path = os.path.join(log_dir, "{}.log".format(log_name))
+    if PROFILER is not None:
+        args = [*args, "--profile", os.path.join(log_dir, "{}.trace.json".format(log_name))]
+    cluster_dir = tempfile.mkdtemp(prefix="jupyterhub-pachyderm-")
+    start = time.monotonic()
+
+    try:
+        with open(log_path, "w") as log:
+            try:
+                env = dict(os.environ, **isolate_cluster(cluster_dir, kube_context, pach_context))
+            except ApplicationError as e:
+                print("error: {}".format(e), file=log)
+                returncode = None
+            else:
+                log.flush()
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), *args], stdout=log, stderr=subprocess.STDOUT, env=env)
+                returncode = proc.returncode
+    finally:
+        shutil.rmtree(cluster_dir, ignore_errors=True)
+
+    # the last error in the log is the most useful summary of a failure
+    error = None
+    if returncode != 0:
+        with open(log_path, "r") as f:
+            errors = [line.strip() for line in f if line.startswith("error: ")]
+        error = errors[-1][len("error: "):] if errors else "exited with code {}".format(returncode)
+
+    if PROFILER is not None:
+        PROFILER.add("cluster", "{} / {}".format(kube_context, pach_context), start, time.monotonic(), exit_code=returncode, log=log_path)
+
+    return {
+        "cluster": "{} / {}".format(kube_context, pach_context),
+        "seconds": time.monotonic() - start,
+        "error": error,
+        "log": log_path,
+    }
+
+def main_fleet(debug, clusters, parallelism, log_dir, jupyterhub_version, args):
+    # the helm repo cache is shared by every cluster, so set it up once,
+    # rather than having the deployments race to update it
+    print_section("configuring helm")
+    run_version_check("helm", "version")
+    configure_helm(debug, jupyterhub_version)
+
+    if not log_dir:
+        log_dir = tempfile.mkdtemp(prefix="jupyterhub-pachyderm-fleet-")
+    os.makedirs(log_dir, exist_ok=True)
+
+    print_section("deploying to {} clusters (logs in {})".format(len(clusters), log_dir))
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = [executor.submit(deploy_cluster, i, kube_context, pach_context, log_dir, args) for (i, (kube_context, pach_context)) in enumerate(clusters)]
+        results = []
+        for future in futures:
+            result = future.result()
+            print("{}: {} ({:.1f}s)".format(result["cluster"], "failed" if result["error"] else "done", result["seconds"]))
+            results.append(result)
+
+    print_section("summary")
+    width = max(len("cluster"), *(len(result["cluster"]) for result in results))
+    print("{:<{width}}  {:<6}  {:>8}  {}".format("cluster", "status", "duration", "log / error", width=width))
+    for result in results:
+        print("{:<{width}}  {:<6}  {:>7.1f}s  {}".format(
+            result["cluster"],
+            "failed" if result["error"] else "ok",
+            result["seconds"],
+            result["error"] or result["log"],
+            width=width,
+        ))
+
+    failures = sum(1 for result in results if result["error"])
+    if failures:
+        raise ApplicationError("{} of {} clusters failed to deploy".format(failures, len(results)))
+
+def positive_int(value):
+    """Parses a command-line argument that must be a positive integer"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be a positive integer, got '{}'".format(value))
+    return number
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sets up JupyterHub on a kubernetes cluster that has Pachyderm running on it.")
     parser.add_argument("--debug", default=False, action="store_true", help="Debug mode")
@@ -223,6 +1072,19 @@ if __name__ == "__main__":
     parser.add_argument("--tls-host", default="", help="If set, TLS is enabled on JupyterHub via Let's Encrypt. The value is a hostname associated with the TLS certificate.")
     parser.add_argument("--tls-email", default="", help="If set, TLS is enabled on JupyterHub via Let's Encrypt. The value is an email address associated with the TLS certificate.")
     parser.add_argument("--use-version", default="", help="If set, the specified version of jupyterhub-pachyderm is deployed. Defaults to a stable release.")
+    parser.add_argument("--rotate-secrets", default=False, action="store_true", help="Generate new secrets and a new pach auth token, rather than reusing those of the existing installation. This makes users' stored auth state unreadable, so they have to log in again.")
+    parser.add_argument("--rotate-pach-auth-token", default=False, action="store_true", help="Generate a new pach auth token, e.g. if the existing installation's has expired, while reusing its other secrets.")
+    parser.add_argument("--force-upgrade", default=False, action="store_true", help="Upgrade the installation even if its config hasn't changed.")
+    parser.add_argument("--wait-timeout", default=600, type=float, help="Seconds to wait for JupyterHub to be ready after installing it. Set to 0 to not wait.")
+    parser.add_argument("--values", default=[], action="append", metavar="FILE", help="YAML or JSON file of helm values to merge over the generated ones. Can be given more than once; later files take precedence.")
+    parser.add_argument("--set", default=[], action="append", metavar="KEY=VALUE", help="Helm value to set, e.g. `--set singleuser.memory.limit=2G`, taking precedence over values files. Values are parsed as JSON if possible.")
+    parser.add_argument("--set-string", default=[], action="append", metavar="KEY=VALUE", help="Like --set, but the value is always a string, e.g. `--set-string hub.image.tag=1.2`. These take precedence over --set.")
+    parser.add_argument("--render-only", default=False, action="store_true", help="Print the helm values and exit, without contacting the cluster or running any other commands.")
+    parser.add_argument("--fleet", default=[], action="append", metavar="KUBE_CONTEXT=PACH_CONTEXT", help="Deploy to the cluster with the given kubernetes and pachyderm contexts, rather than the active ones. Can be given more than once, to deploy to several clusters concurrently.")
+    parser.add_argument("--fleet-parallelism", default=4, type=positive_int, help="Maximum number of clusters to deploy to at once.")
+    parser.add_argument("--fleet-log-dir", default="", help="Directory to write each cluster's deployment log to. Defaults to a new temporary directory.")
+    parser.add_argument("--teardown", default=False, action="store_true", help="Delete the JupyterHub installation, including user pods and their storage, and wait until it's gone. --wait-timeout applies. With --dry-run, only lists what would be deleted.")
+    parser.add_argument("--profile", default="", metavar="FILE", help="Record how long each section and command takes, print a summary, and write a trace to FILE that can be loaded into chrome://tracing or Perfetto. Command output is streamed rather than inherited. In fleet mode, each cluster's trace is written next to its log.")
     args = parser.parse_args()
 
     # validate args
@@ -232,6 +1094,22 @@ if __name__ == "__main__":
     if args.tls_email and not args.tls_host:
         print("TLS email specified, but no host", file=sys.stderr)
         sys.exit(1)
+    if args.render_only and args.fleet:
+        print("--render-only cannot be used with --fleet", file=sys.stderr)
+        sys.exit(1)
+    if args.teardown and (args.render_only or args.fleet):
+        print("--teardown cannot be used with --render-only or --fleet", file=sys.stderr)
+        sys.exit(1)
+    if args.fleet and args.tls_host:
+        print("TLS cannot be used with --fleet, since each cluster needs its own host", file=sys.stderr)
+        sys.exit(1)
+    clusters = []
+    for cluster in args.fleet:
+        kube_context, sep, pach_context = cluster.rpartition("=")
+        if not sep or not kube_context or not pach_context:
+            print("invalid --fleet value '{}'; expected KUBE_CONTEXT=PACH_CONTEXT".format(cluster), file=sys.stderr)
+            sys.exit(1)
+        clusters.append((kube_context, pach_context))
 
     # get the version
     with open("version.json", "r") as f:
@@ -239,18 +1117,64 @@ if __name__ == "__main__":
         jupyterhub_version = j["jupyterhub"]
         default_version = j["jupyterhub_pachyderm"]
 
+    if args.profile:
+        PROFILER = Profiler()
+
+    exit_code = 1
     try:
-        main(
-            args.debug,
-            args.no_verify_contexts,
-            args.dry_run,
-            args.tls_host,
-            args.tls_email,
-            jupyterhub_version,
-            args.use_version or default_version
-        )
+        overrides = load_overrides(args.values, args.set, args.set_string)
+
+        if args.teardown:
+            main_teardown(args.dry_run, args.wait_timeout)
+        elif args.render_only:
+            print(render_only(args.use_version or default_version, args.tls_host, args.tls_email, overrides))
+        elif clusters:
+            # each cluster is deployed by running this script again, with
+            # the same options
+            cluster_args = [flag for (flag, enabled) in [
+                ("--debug", args.debug),
+                ("--no-verify-contexts", args.no_verify_contexts),
+                ("--dry-run", args.dry_run),
+                ("--rotate-secrets", args.rotate_secrets),
+                ("--rotate-pach-auth-token", args.rotate_pach_auth_token),
+                ("--force-upgrade", args.force_upgrade),
+            ] if enabled]
+            if args.use_version:
+                cluster_args += ["--use-version", args.use_version]
+            cluster_args += ["--wait-timeout", str(args.wait_timeout)]
+            for path in args.values:
+                cluster_args += ["--values", os.path.abspath(path)]
+            for setting in args.set:
+                cluster_args += ["--set", setting]
+            for setting in args.set_string:
+                cluster_args += ["--set-string", setting]
+            main_fleet(args.debug, clusters, args.fleet_parallelism, args.fleet_log_dir, jupyterhub_version, cluster_args)
+        else:
+            main(
+                args.debug,
+                args.no_verify_contexts,
+                args.dry_run,
+                args.tls_host,
+                args.tls_email,
+                jupyterhub_version,
+                args.use_version or default_version,
+                args.rotate_secrets,
+                args.rotate_pach_auth_token,
+                args.force_upgrade,
+                overrides,
+                args.wait_timeout,
+            )
+        exit_code = 0
     except ApplicationError as e:
         print("error: {}".format(e), file=sys.stderr)
         if args.debug:
             traceback.print_exc()
-        sys.exit(2)
+        exit_code = 2
+    finally:
+        if PROFILER is not None:
+            PROFILER.end_section()
+            print("===> profile (trace written to {})".format(args.profile))
+            PROFILER.print_summary()
+            PROFILER.write(args.profile, exit_code)
+
+    sys.exit(exit_code)